@@ -5,13 +5,42 @@ __docformat__ = "google"
 
 import os
 import sys
+from typing import Any
 
 import click
-from loguru import logger as logging
-from rich.pretty import pprint
 
-from ielove import ielove
-from ielove.db import get_collection
+# Heavy dependencies (bs4, pymongo, requests, rich, the tasks module...) are
+# imported in the commands that need them, to keep the startup time of
+# enqueue-only commands low. Check with `make importtime-check`.
+
+ENQUEUE_ONLY = ["scrape-property-page", "scrape-result-page"]
+"""
+Commands that only enqueue a task (see `_send_task`). They do not log, and
+logging is not set up for them, so that loguru is not even imported.
+"""
+
+
+class _Logger:  # pylint: disable=too-few-public-methods
+    """loguru's logger, imported on first use"""
+
+    def __getattr__(self, name: str) -> Any:
+        from loguru import logger
+
+        return getattr(logger, name)
+
+
+logging = _Logger()
+
+
+def _send_task(name: str, *args) -> None:
+    """
+    Enqueues a task of `ielove.tasks` by name in the interactive queue (see
+    `ielove.celery.QUEUES`). This avoids importing Celery, the tasks module,
+    and their dependencies, see `ielove.celery.send_task`.
+    """
+    from ielove.celery import send_task
+
+    send_task(f"ielove.tasks.{name}", args)
 
 
 def _setup_logging(logging_level: str = "INFO") -> None:
@@ -56,9 +85,41 @@ def _setup_logging(logging_level: str = "INFO") -> None:
         case_sensitive=False,
     ),
 )
-def main(logging_level: str):
+@click.option(
+    "--profile/--no-profile",
+    type=bool,
+    default=False,
+    help=(
+        "Profiles the command and writes a cProfile report in the directory "
+        "given by the IELOVE_PROFILE_DIR environment variable (default: "
+        "'profiles')."
+    ),
+)
+@click.option(
+    "--http-cache",
+    default=os.getenv("IELOVE_CACHE_MODE", "off"),
+    help=(
+        "HTTP cache mode, among 'off', 'record', 'replay', and "
+        "'refresh-older-than'. See ielove.cache."
+    ),
+    type=click.Choice(
+        ["off", "record", "replay", "refresh-older-than"],
+        case_sensitive=False,
+    ),
+)
+@click.pass_context
+def main(
+    ctx: click.Context, logging_level: str, profile: bool, http_cache: str
+):
     """Entrypoint."""
-    _setup_logging(logging_level)
+    if ctx.invoked_subcommand not in ENQUEUE_ONLY:
+        _setup_logging(logging_level)
+    os.environ["IELOVE_CACHE_MODE"] = http_cache
+    if profile:
+        from ielove.metrics import Profiler
+
+        profiler = Profiler(1, os.getenv("IELOVE_PROFILE_DIR", "profiles"))
+        ctx.with_resource(profiler.profile(ctx.invoked_subcommand or "main"))
 
 
 @main.command()
@@ -71,11 +132,82 @@ def main(logging_level: str):
 @click.argument("url", type=str)
 def get_property(url: str, commit: bool):
     """Scrapes a property page and prints the results"""
+    from rich.pretty import pprint
+
+    from ielove import ielove, stats
+    from ielove.db import get_collection
+
     data = ielove.scrape_property_page(url)
     pprint(data)
     if commit:
         collection = get_collection("properties")
         collection.insert_one(data)
+        stats.update(None, data)
+
+
+@main.command()
+@click.option(
+    "-b", "--batch-size", type=int, default=1000, help="Archiving batch size"
+)
+def archive_delisted(batch_size: int):
+    """
+    Moves the properties that have not been seen for a while to the archive
+    """
+    from ielove import archive
+
+    archive.archive_delisted(batch_size)
+
+
+@main.command()
+def check_queries():
+    """
+    Explains all the queries issued by ielove, and reports those that do a
+    collection scan. Exits with code 1 if there are any.
+    """
+    from ielove.db import check_queries as _check_queries
+
+    collscans = 0
+    for r in _check_queries():
+        collscans += r["collscan"]
+        msg = "{} {} sort={}: {}"
+        args = [
+            r["collection"],
+            r["filter"],
+            r["sort"],
+            " <- ".join(r["stages"]),
+        ]
+        if r["collscan"]:
+            logging.warning("COLLSCAN " + msg, *args)
+        else:
+            logging.info(msg, *args)
+    if collscans:
+        sys.exit(1)
+
+
+@main.command()
+@click.argument("region", type=str)
+@click.argument("property_type", type=str)
+@click.option("-l", "--limit", type=int, default=100, help="Result page limit")
+def discover_region(region: str, property_type: str, limit: int):
+    """
+    Streams the result pages of a given type in a given region, and
+    asynchronously scrapes all the properties found. Lighter than
+    scrape-region.
+    """
+    from ielove import tasks
+
+    # Bound task, self is passed by Celery
+    # pylint: disable=no-value-for-parameter
+    n = tasks.discover_region(region, property_type, limit=limit)
+    logging.info("Submitted {} tasks", n)
+
+
+@main.command()
+def ensure_indices():
+    """Creates the missing database indices"""
+    from ielove.db import ensure_indices as _ensure_indices
+
+    _ensure_indices()
 
 
 @main.command()
@@ -85,6 +217,9 @@ def get_properties(url: str):
     Scrapes all property pages referenced by the given result page, and commits
     everything to database
     """
+    from ielove import ielove
+    from ielove.db import get_collection
+
     data = ielove.scrape_result_page(url)
     collection = get_collection("properties")
     for page in data["pages"]:
@@ -99,9 +234,28 @@ def get_properties(url: str):
 @click.argument("url", type=str)
 def scrape_property_page(url: str):
     """Asynchronously scrapes property page and commits the results"""
+    _send_task("scrape_property_page", url)
+
+
+@main.command()
+@click.argument("file", type=click.File("r"), default="-")
+@click.option(
+    "-c",
+    "--chunk-size",
+    type=int,
+    default=1000,
+    help="Number of URLs checked and submitted at once",
+)
+def scrape_property_pages(file, chunk_size: int):
+    """
+    Asynchronously scrapes all property pages listed in a file (one URL per
+    line, or stdin by default), and commits the results. Duplicates and
+    recently scraped pages are skipped.
+    """
     from ielove import tasks
 
-    tasks.scrape_property_page.delay(url)
+    n = tasks.submit_property_pages(file, chunk_size=chunk_size)
+    logging.info("Submitted {} tasks", n)
 
 
 @main.command()
@@ -114,6 +268,8 @@ def scrape_region(region: str, property_type: str, limit: int):
     """
     from ielove import tasks
 
+    # Bound task, self is passed by Celery
+    # pylint: disable=no-value-for-parameter
     tasks.scrape_region(region, property_type, limit=limit)
 
 
@@ -124,9 +280,247 @@ def scrape_result_page(url: str):
     Asynchronously scrapes all properties in a given result page, and commits
     the results
     """
-    from ielove import tasks
+    _send_task("scrape_result_page", url)
+
+
+def _parse_list(kind: type):
+    """Click callback parsing a comma-separated list of values"""
+
+    def _callback(ctx, param, value: str) -> list:
+        try:
+            return [kind(x) for x in value.split(",")]
+        except ValueError as e:
+            raise click.BadParameter(str(e), ctx, param) from e
+
+    return _callback
+
+
+@main.command()
+@click.option(
+    "-w",
+    "--workers",
+    default="1",
+    callback=_parse_list(int),
+    help="Comma-separated numbers of workers",
+)
+@click.option(
+    "-c",
+    "--concurrency",
+    default="4",
+    callback=_parse_list(int),
+    help="Comma-separated numbers of processes per worker",
+)
+@click.option(
+    "-p",
+    "--prefetch",
+    default="1",
+    callback=_parse_list(int),
+    help="Comma-separated prefetch multipliers",
+)
+@click.option(
+    "-i",
+    "--min-interval",
+    default="0.05",
+    callback=_parse_list(float),
+    help="Comma-separated minimal intervals between requests (in seconds)",
+)
+@click.option(
+    "--discover/--no-discover",
+    default=False,
+    help="Use discover_region instead of scrape_region",
+)
+@click.option("-t", "--property-type", default="chintai", type=str)
+@click.option("-r", "--regions", default=4, type=int, help="Number of regions")
+@click.option("--pages", default=5, type=int, help="Result pages per region")
+@click.option(
+    "--listings", default=20, type=int, help="Properties per result page"
+)
+@click.option(
+    "--latency", default=0.1, type=float, help="Mean site latency (seconds)"
+)
+@click.option(
+    "--error-rate", default=0.0, type=float, help="Proportion of 503s"
+)
+@click.option(
+    "--throttle-rate", default=0.0, type=float, help="Proportion of 429s"
+)
+@click.option(
+    "--page-size", default=65536, type=int, help="HTML page size (bytes)"
+)
+@click.option(
+    "--db-latency",
+    default=0.0,
+    type=float,
+    help="Round-trip time added to Redis and MongoDB (seconds)",
+)
+@click.option(
+    "--timeout", default=600, type=float, help="Maximal run time (seconds)"
+)
+@click.option("--redis-db", default=15, type=int, help="Emptied at each run")
+@click.option(
+    "--mongo-db", default="ielove_loadtest", help="Emptied at each run"
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    help="Writes the results, including time series, as JSON lines",
+)
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+# pylint: disable=too-many-locals
+def load_test(
+    workers: list,
+    concurrency: list,
+    prefetch: list,
+    min_interval: list,
+    discover: bool,
+    property_type: str,
+    regions: int,
+    pages: int,
+    listings: int,
+    latency: float,
+    error_rate: float,
+    throttle_rate: float,
+    page_size: int,
+    db_latency: float,
+    timeout: float,
+    redis_db: int,
+    mongo_db: str,
+    output,
+):
+    """
+    Runs the scraping pipeline against a local fake site for every
+    combination of settings, and prints throughput, task latency, queue
+    depth, and database load. Needs Redis and MongoDB. See ielove.loadtest.
+    """
+    import json
+    from itertools import product
+
+    from rich.console import Console
+    from rich.table import Table
+
+    if mongo_db == os.environ.get("MONGO_DB", "ielove"):
+        raise click.BadParameter(
+            "Must not be the main database", param_hint="--mongo-db"
+        )
+    if redis_db == int(os.environ.get("REDIS_DB", "0")):
+        raise click.BadParameter(
+            "Must not be the broker database", param_hint="--redis-db"
+        )
+
+    from ielove import loadtest
+    from ielove.ielove import ALL_REGIONS
+
+    site = loadtest.FakeSite(
+        pages=pages,
+        listings=listings,
+        latency=latency,
+        error_rate=error_rate,
+        throttle_rate=throttle_rate,
+        page_size=page_size,
+    )
+    site.start()
+    settings = [
+        loadtest.Setting(*x)
+        for x in product(workers, concurrency, prefetch, min_interval)
+    ]
+    partitions = [(property_type, r) for r in ALL_REGIONS[:regions]]
+    task = "discover_region" if discover else "scrape_region"
+    columns = [
+        "workers",
+        "concurrency",
+        "prefetch",
+        "min_interval",
+        "elapsed",
+        "properties",
+        "throughput",
+        "errors",
+        "p50",
+        "p99",
+        "max_queued",
+        "db_ops_per_s",
+        "redis_ops_per_s",
+    ]
+    table = Table()
+    for c in columns:
+        table.add_column(c)
+    try:
+        for r in loadtest.sweep(
+            site,
+            settings,
+            partitions,
+            task,
+            timeout,
+            db_latency,
+            redis_db=redis_db,
+            mongo_db=mongo_db,
+        ):
+            if output is not None:
+                output.write(json.dumps(r) + "\n")
+                output.flush()
+            table.add_row(
+                *[
+                    f"{r[c]:,.3f}" if isinstance(r[c], float) else str(r[c])
+                    for c in columns
+                ]
+            )
+            if r["timed_out"]:
+                logging.warning(
+                    "Run with {} workers, concurrency {}, prefetch {}, and "
+                    "minimal interval {}s timed out",
+                    *[r[c] for c in columns[:4]],
+                )
+    finally:
+        site.stop()
+    Console().print(table)
+
+
+@main.command()
+def rebuild_stats():
+    """Recomputes all market statistics from the properties collection"""
+    from ielove import stats
+
+    n = stats.rebuild()
+    logging.info("Rebuilt statistics of {} groups", n)
+
+
+@main.command("stats")
+@click.option("-t", "--property-type", type=str, help="e.g. chintai")
+@click.option("-p", "--prefecture", type=str, help="e.g. 東京都")
+def show_stats(property_type: str, prefecture: str):
+    """
+    Prints market statistics (mean price, mean area, mean and quartiles of
+    price per m²) by property type, prefecture, city, and ward
+    """
+    from rich.console import Console
+    from rich.table import Table
+
+    from ielove.stats import get_stats
 
-    tasks.scrape_result_page.delay(url)
+    table = Table()
+    columns = [
+        "type",
+        "prefecture",
+        "city",
+        "ward",
+        "count",
+        "mean_price",
+        "mean_area",
+        "mean_price_per_m2",
+        "q1_price_per_m2",
+        "median_price_per_m2",
+        "q3_price_per_m2",
+    ]
+    for c in columns:
+        table.add_column(c)
+    for r in get_stats(property_type, prefecture):
+        table.add_row(
+            *[
+                f"{r[c]:,.0f}" if isinstance(r[c], float) else str(r[c])
+                for c in columns
+            ]
+        )
+    Console().print(table)
 
 
 # pylint: disable=no-value-for-parameter
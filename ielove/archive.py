@@ -0,0 +1,124 @@
+"""
+Hot/cold tiering of property documents. Properties that are no longer listed
+are moved from `properties` to the compressed `properties_archive`
+collection, so that the working set (and its indices) stays close to the
+number of live listings. A property is considered delisted if
+- its page returns a 404 or 410 (reason `gone`), or
+- it has not been seen in any result page, nor successfully scraped, in the
+  last `IELOVE_DELISTED_AFTER_DAYS` days (default: 90, i.e. three monthly
+  result page sweeps; reason `unseen`), see `archive_delisted`.
+
+Archived properties get a tombstone in the `tombstones` collection, which
+prevents them from being scraped again. The tombstone is removed if the
+property reappears in a result page (see `mark_seen`).
+"""
+
+import os
+from datetime import datetime, timedelta
+from typing import Iterable, List, Set
+
+from loguru import logger as logging
+from pymongo import ReplaceOne, UpdateOne
+
+from ielove import stats
+from ielove.db import get_collection
+from ielove.metrics import ARCHIVED_PROPERTIES
+
+
+def _archive_documents(
+    documents: List[dict], pids: Iterable[str], reason: str
+) -> int:
+    """
+    Moves property documents to the archive, and tombstones the given pids
+    (which should include those of the documents). Returns the number of
+    archived documents.
+    """
+    now = datetime.now()
+    tombstones = [
+        UpdateOne(
+            {"pid": pid},
+            {"$set": {"pid": pid, "datetime": now, "reason": reason}},
+            upsert=True,
+        )
+        for pid in pids
+    ]
+    if tombstones:
+        get_collection("tombstones").bulk_write(tombstones, ordered=False)
+    if not documents:
+        return 0
+    get_collection("properties_archive").bulk_write(
+        [
+            ReplaceOne(
+                {"pid": d["pid"]},
+                {
+                    **{k: v for k, v in d.items() if k != "_id"},
+                    "archived": {"datetime": now, "reason": reason},
+                },
+                upsert=True,
+            )
+            for d in documents
+        ],
+        ordered=False,
+    )
+    get_collection("properties").delete_many(
+        {"_id": {"$in": [d["_id"] for d in documents]}}
+    )
+    for d in documents:
+        stats.update(d, None)
+    ARCHIVED_PROPERTIES.labels(reason).inc(len(documents))
+    return len(documents)
+
+
+def archive(pids: List[str], reason: str) -> int:
+    """
+    Archives and tombstones properties. Pids that are not in the `properties`
+    collection are still tombstoned. Returns the number of archived documents.
+    """
+    documents = list(get_collection("properties").find({"pid": {"$in": pids}}))
+    n = _archive_documents(documents, pids, reason)
+    logging.info("Archived {} properties ({})", n, reason)
+    return n
+
+
+def archive_delisted(batch_size: int = 1000) -> int:
+    """
+    Archives all properties that have not been seen for a while (see module
+    documentation), by batches of `batch_size`. Returns the number of archived
+    documents.
+    """
+    days = float(os.environ.get("IELOVE_DELISTED_AFTER_DAYS", "90"))
+    cutoff = datetime.now() - timedelta(days=days)
+    query = {
+        "$or": [
+            {"last_seen": {"$lt": cutoff}},
+            {"last_seen": None, "datetime": {"$lt": cutoff}},
+        ]
+    }
+    collection, n = get_collection("properties"), 0
+    while documents := list(collection.find(query, limit=batch_size)):
+        n += _archive_documents(
+            documents, [d["pid"] for d in documents], "unseen"
+        )
+    logging.info("Archived {} delisted properties", n)
+    return n
+
+
+def mark_seen(pids: List[str]) -> None:
+    """
+    Records that properties have been seen in a result page, and removes
+    their tombstones if any
+    """
+    if not pids:
+        return
+    get_collection("properties").update_many(
+        {"pid": {"$in": pids}}, {"$set": {"last_seen": datetime.now()}}
+    )
+    get_collection("tombstones").delete_many({"pid": {"$in": pids}})
+
+
+def tombstoned(pids: Iterable[str]) -> Set[str]:
+    """Returns the pids among `pids` that have a tombstone"""
+    documents = get_collection("tombstones").find(
+        {"pid": {"$in": list(pids)}}, projection={"pid": 1}
+    )
+    return {d["pid"] for d in documents}
@@ -0,0 +1,247 @@
+"""
+On-disk HTTP cache used by `ielove.utils.fetch`, mostly for development and
+for re-runs. The behaviour is set by the `IELOVE_CACHE_MODE` environment
+variable (or by the `--http-cache` CLI option):
+- `off` (default): the cache is not used;
+- `record`: every request is sent, and successful responses are stored;
+- `replay`: responses are served from the cache, and a request that is not in
+  the cache raises a `CacheMissError`. Nothing is sent over the network;
+- `refresh-older-than`: responses are served from the cache unless they are
+  older than `IELOVE_CACHE_MAX_AGE` seconds (default: one day), in which case
+  the request is sent and the response is stored.
+
+Response bodies are compressed and stored in `IELOVE_CACHE_DIR` (default:
+`.cache/http`) under the hash of their content, so identical responses are
+stored once. The index mapping requests to bodies is an SQLite database read
+through memory-mapped I/O, which keeps lookups fast with millions of entries
+and can be shared by several processes. When the bodies take more than
+`IELOVE_CACHE_SIZE` bytes (default: 1 GiB), the least recently used entries
+are evicted.
+"""
+
+import json
+import os
+import sqlite3
+import zlib
+from hashlib import sha256
+from pathlib import Path
+from time import time
+from typing import Optional, Tuple, cast
+
+from loguru import logger as logging
+from requests import PreparedRequest, Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+MODES = ["off", "record", "replay", "refresh-older-than"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    object TEXT NOT NULL,
+    url TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_object ON entries (object);
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO stats (id, size) VALUES (0, 0);
+"""
+
+_connection: Optional[Tuple[int, sqlite3.Connection]] = None
+"""Index connection and the pid of the process that opened it"""
+
+
+class CacheMissError(RuntimeError):
+    """Raised in `replay` mode when a request is not in the cache"""
+
+
+def _directory() -> Path:
+    """Cache directory"""
+    return Path(os.environ.get("IELOVE_CACHE_DIR", ".cache/http"))
+
+
+def _index() -> sqlite3.Connection:
+    """
+    Returns the connection to the index, opening it if necessary (or if the
+    process has been forked since)
+    """
+    global _connection  # pylint: disable=global-statement
+    if _connection is None or _connection[0] != os.getpid():
+        _directory().mkdir(parents=True, exist_ok=True)
+        db = sqlite3.connect(
+            _directory() / "index.sqlite3", timeout=30, isolation_level=None
+        )
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA mmap_size = 1073741824")
+        db.executescript(_SCHEMA)
+        _connection = (os.getpid(), db)
+    return _connection[1]
+
+
+def _object_path(h: str) -> Path:
+    """Path of a stored body, given its hash"""
+    return _directory() / "objects" / h[:2] / h[2:]
+
+
+def _evict() -> None:
+    """
+    Evicts least recently used entries until stored bodies take less than 90%
+    of `IELOVE_CACHE_SIZE`
+    """
+    max_size = int(os.environ.get("IELOVE_CACHE_SIZE", str(2**30)))
+    db = _index()
+    size = db.execute("SELECT size FROM stats").fetchone()[0]
+    if size <= max_size:
+        return
+    n = 0
+    while size > 0.9 * max_size:
+        rows = db.execute(
+            "SELECT key, object FROM entries ORDER BY accessed LIMIT 100"
+        ).fetchall()
+        if not rows:
+            break
+        for k, h in rows:
+            db.execute("DELETE FROM entries WHERE key = ?", (k,))
+            n += 1
+            size -= _delete_object(h)
+    logging.debug("Evicted {} HTTP cache entries", n)
+
+
+def _delete_object(h: str) -> int:
+    """
+    Deletes a stored body unless it is still used by an entry, and returns the
+    freed size
+    """
+    db = _index()
+    if db.execute(
+        "SELECT 1 FROM entries WHERE object = ? LIMIT 1", (h,)
+    ).fetchone():
+        return 0
+    row = db.execute("SELECT size FROM objects WHERE hash = ?", (h,))
+    if (row := row.fetchone()) is None:
+        return 0
+    db.execute("DELETE FROM objects WHERE hash = ?", (h,))
+    db.execute("UPDATE stats SET size = size - ?", (row[0],))
+    _object_path(h).unlink(missing_ok=True)
+    return row[0]
+
+
+def get_mode() -> str:
+    """Current cache mode, see module documentation"""
+    mode = os.environ.get("IELOVE_CACHE_MODE", "off").lower()
+    if mode not in MODES:
+        raise ValueError(
+            f"Invalid HTTP cache mode '{mode}'. Must be one of {MODES}"
+        )
+    return mode
+
+
+def key(request: PreparedRequest) -> str:
+    """Cache key of a request: hash of its method, URL, and body"""
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    h = sha256(f"{request.method} {request.url}\n".encode("utf-8"))
+    h.update(cast(bytes, body))  # Bodies are never streamed here
+    return h.hexdigest()
+
+
+def load(request: PreparedRequest) -> Optional[Response]:
+    """
+    Returns the cached response to a request, or `None` if there is none or
+    if it should be refreshed (see module documentation). In `replay` mode,
+    raises a `CacheMissError` instead of returning `None`.
+    """
+    mode = get_mode()
+    if mode in ["off", "record"]:
+        return None
+    k, db = key(request), _index()
+    row = db.execute(
+        "SELECT object, url, status, headers, created FROM entries "
+        "WHERE key = ?",
+        (k,),
+    ).fetchone()
+    if row is None and mode == "replay":
+        raise CacheMissError(
+            f"{request.method} {request.url} is not in the HTTP cache"
+        )
+    if row is None:
+        return None
+    h, url, status, headers, created = row
+    max_age = float(os.environ.get("IELOVE_CACHE_MAX_AGE", "86400"))
+    if mode == "refresh-older-than" and time() - created > max_age:
+        return None
+    try:
+        content = zlib.decompress(_object_path(h).read_bytes())
+    except (OSError, zlib.error) as e:
+        logging.warning("Corrupted HTTP cache entry {}: {}", k, e)
+        db.execute("DELETE FROM entries WHERE key = ?", (k,))
+        if mode == "replay":
+            raise CacheMissError(
+                f"{request.method} {request.url} is not in the HTTP cache"
+            ) from e
+        return None
+    db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time(), k))
+    response = Response()
+    response.status_code, response.url = status, url
+    response.headers = CaseInsensitiveDict(json.loads(headers))
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.request = request
+    response._content = content
+    return response
+
+
+def store(request: PreparedRequest, response: Response) -> None:
+    """
+    Stores a response if the cache is enabled and if the response is
+    successful
+    """
+    if get_mode() in ["off", "replay"] or not response.ok:
+        return
+    db, h = _index(), sha256(response.content).hexdigest()
+    k, path = key(request), _object_path(h)
+    known = db.execute("SELECT 1 FROM objects WHERE hash = ?", (h,)).fetchone()
+    if known is None or not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = zlib.compress(response.content)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        tmp.replace(path)
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO objects (hash, size) VALUES (?, ?)",
+            (h, len(data)),
+        )
+        if cursor.rowcount == 1:  # Not stored by another process meanwhile
+            db.execute("UPDATE stats SET size = size + ?", (len(data),))
+    previous = db.execute(
+        "SELECT object FROM entries WHERE key = ?", (k,)
+    ).fetchone()
+    now = time()
+    db.execute(
+        "INSERT OR REPLACE INTO entries "
+        "(key, object, url, status, headers, created, accessed) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            k,
+            h,
+            response.url,
+            response.status_code,
+            json.dumps(dict(response.headers)),
+            now,
+            now,
+        ),
+    )
+    if previous is not None and previous[0] != h:
+        _delete_object(previous[0])  # Unless used by another entry
+    _evict()
@@ -1,9 +1,62 @@
-"""Celery app"""
+# pylint: disable=import-outside-toplevel
+"""
+Celery app. Celery, kombu, and redis-py take a few hundred milliseconds to
+import, so they are only imported when needed: the app is built on first
+access to `app` (see `get_app`), and the CLI enqueues tasks with `send_task`,
+which does not need any of them.
+"""
 
+import json
 import os
+import socket
 import sys
+import uuid
+from base64 import b64encode
+from contextlib import ExitStack
+from functools import lru_cache
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Dict, List, Tuple
 
-from celery import Celery
+if TYPE_CHECKING:
+    from celery import Celery
+    from redis import Redis
+
+QUEUES = ["interactive", "discovery", "bulk", "images"]
+"""
+Task queues, by decreasing priority:
+- `interactive`: tasks submitted by hand (CLI or webui) for a single page;
+- `discovery`: result page expansion (`ielove.tasks.scrape_region`,
+  `ielove.tasks.scrape_result_page`, and `ielove.tasks.discover_region`);
+- `bulk`: everything else, in particular property pages scheduled in bulk;
+- `images`: floor plan downloads and thumbnail generation
+  (`ielove.tasks.scrape_floor_plan`), which is CPU bound.
+
+A worker consuming several queues serves them in this order. For interactive
+latency to stay low during large sweeps, run dedicated workers, e.g.
+
+    celery -A ielove.tasks worker -Q interactive -c 2 --prefetch-multiplier 1
+    celery -A ielove.tasks worker -Q discovery -c 4 --prefetch-multiplier 4
+    celery -A ielove.tasks worker -Q bulk -c 8 --prefetch-multiplier 1
+    celery -A ielove.tasks worker -Q images -c 4 --prefetch-multiplier 4
+
+If the `IELOVE_NODE` environment variable is set, the `discovery` and `bulk`
+queues are partitioned across nodes, see `ielove.frontier`.
+"""
+
+app: "Celery"
+"""Default Celery app, built on first access (see `get_app`)"""
+
+INTERACTIVE = {"queue": "interactive", "priority": 0}
+"""`apply_async` options for tasks submitted by hand"""
+
+VISIBILITY_TIMEOUT = 3600
+"""
+In seconds. Tasks reserved by a worker that died without acknowledging them
+are put back into their queue after this delay (see kombu's Redis transport).
+"""
+
+_running_tasks: Dict[str, Tuple[float, ExitStack]] = {}
+"""Start time and profiler context of the tasks running in this process"""
 
 
 def is_worker() -> bool:
@@ -15,13 +68,248 @@ def is_worker() -> bool:
     )
 
 
-def get_app() -> Celery:
-    """Returns a celery app instance"""
-    host = os.environ.get("REDIS_HOST", "localhost")
-    port = os.environ.get("REDIS_PORT", "6379")
-    k = os.environ.get("REDIS_DB", "0")
-    uri = f"redis://{host}:{port}/{k}"
-    return Celery("ielove.tasks", broker=uri)
+def __getattr__(name: str) -> Any:
+    """Builds the default Celery app `app` on first access"""
+    if name == "app":
+        return _get_default_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _connect_signals() -> None:
+    """Connects the worker and task signal handlers below"""
+    from celery import signals
+
+    for signal, handler in [
+        (signals.worker_init, _on_worker_init),
+        (signals.celeryd_after_setup, _on_worker_setup),
+        (signals.worker_ready, _on_worker_ready),
+        (signals.worker_shutdown, _on_worker_shutdown),
+        (signals.task_prerun, _on_task_prerun),
+        (signals.task_postrun, _on_task_postrun),
+    ]:
+        signal.connect(
+            handler, weak=False, dispatch_uid=f"ielove.{handler.__name__}"
+        )
+
+
+@lru_cache(maxsize=1)
+def _get_default_app() -> "Celery":
+    """The app used by `ielove.tasks`, see `get_app`"""
+    return get_app()
+
+
+def _redis_address() -> Tuple[str, int, int]:
+    """
+    Host, port, and database number of the Redis database used as broker,
+    see `get_redis_uri`
+    """
+    return (
+        os.environ.get("REDIS_HOST", "localhost"),
+        int(os.environ.get("REDIS_PORT", "6379")),
+        int(os.environ.get("REDIS_DB", "0")),
+    )
+
+
+def _redis_execute(commands: List[List[str]]) -> None:
+    """
+    Sends commands to the broker over a bare connection (RESP protocol), and
+    raises a `ConnectionError` if any of them fails. Replies are discarded.
+    """
+    payload = b""
+    for command in commands:
+        payload += f"*{len(command)}\r\n".encode("utf-8")
+        for arg in map(lambda x: x.encode("utf-8"), command):
+            payload += f"${len(arg)}\r\n".encode("utf-8") + arg + b"\r\n"
+    host, port, _ = _redis_address()
+    with socket.create_connection((host, port), timeout=10) as connection:
+        connection.sendall(payload)
+        replies = connection.makefile("rb")
+        for _ in commands:
+            # SELECT and LPUSH have single-line replies
+            line = replies.readline()
+            if not line or line.startswith(b"-"):
+                raise ConnectionError(
+                    f"Redis error: {line.decode('utf-8', 'replace').strip()}"
+                )
+
+
+def get_app() -> "Celery":
+    """Returns a celery app instance, see also `QUEUES`"""
+    from celery import Celery
+    from kombu import Queue
+
+    _connect_signals()
+    app_ = Celery("ielove.tasks", broker=get_redis_uri())
+    app_.conf.update(
+        broker_transport_options={
+            "priority_steps": list(range(10)),
+            "queue_order_strategy": "priority",
+            "sep": ":",
+            "visibility_timeout": VISIBILITY_TIMEOUT,
+        },
+        task_default_priority=5,
+        task_default_queue="bulk",
+        task_queues=[Queue(q, routing_key=q) for q in QUEUES],
+        task_routes={
+            "ielove.tasks.discover_region": {"queue": "discovery"},
+            "ielove.tasks.scrape_region": {"queue": "discovery"},
+            "ielove.tasks.scrape_result_page": {"queue": "discovery"},
+            "ielove.tasks.scrape_floor_plan": {"queue": "images"},
+        },
+        worker_prefetch_multiplier=1,
+    )
+    return app_
+
+
+@lru_cache(maxsize=1)
+def get_redis() -> "Redis":
+    """
+    Returns a client to the Redis database used as broker. It is created on
+    first call.
+    """
+    from redis import Redis
+
+    return Redis.from_url(get_redis_uri())
+
+
+def get_redis_uri() -> str:
+    """
+    Returns the URI of the Redis database used as broker, which is set by the
+    `REDIS_HOST`, `REDIS_PORT`, and `REDIS_DB` environment variables
+    """
+    host, port, k = _redis_address()
+    return f"redis://{host}:{port}/{k}"
+
+
+def send_task(name: str, args: tuple = (), queue: str = "interactive") -> str:
+    """
+    Enqueues a task by name at the highest priority of a queue, and returns
+    its id. The message (Celery task protocol 2, as stored by kombu's Redis
+    transport) is pushed directly to the queue's list, so neither Celery nor
+    redis-py are imported.
+
+    Args:
+        name (str): e.g. `ielove.tasks.scrape_property_page`
+        args (tuple): Positional arguments of the task, JSON serializable
+        queue (str): See `QUEUES`
+    """
+    task_id = str(uuid.uuid4())
+    embed = {"callbacks": None, "errbacks": None, "chain": None, "chord": None}
+    body = json.dumps([list(args), {}, embed]).encode("utf-8")
+    message = {
+        "body": b64encode(body).decode("utf-8"),
+        "content-encoding": "utf-8",
+        "content-type": "application/json",
+        "headers": {
+            "lang": "py",
+            "task": name,
+            "id": task_id,
+            "shadow": None,
+            "eta": None,
+            "expires": None,
+            "group": None,
+            "group_index": None,
+            "retries": 0,
+            "timelimit": [None, None],
+            "root_id": task_id,
+            "parent_id": None,
+            "argsrepr": repr(tuple(args)),
+            "kwargsrepr": "{}",
+            "origin": f"{os.getpid()}@{socket.gethostname()}",
+            "ignore_result": False,
+            "replaced_task_nesting": 0,
+            "stamped_headers": None,
+            "stamps": {},
+        },
+        "properties": {
+            "correlation_id": task_id,
+            "reply_to": "",
+            "delivery_mode": 2,
+            "delivery_info": {"exchange": "", "routing_key": queue},
+            "priority": 0,
+            "body_encoding": "base64",
+            "delivery_tag": str(uuid.uuid4()),
+        },
+    }
+    _, _, k = _redis_address()
+    _redis_execute([["SELECT", str(k)], ["LPUSH", queue, json.dumps(message)]])
+    return task_id
+
+
+# pylint: disable=unused-argument
+def _on_worker_init(**kwargs) -> None:
+    """
+    Starts the Prometheus endpoint (see `ielove.metrics`), and ensures that
+    the database indices exist (see `ielove.db.ensure_indices`)
+    """
+    from loguru import logger as logging
+
+    from ielove import db, metrics
+
+    metrics.start_metrics_server()
+    try:
+        db.ensure_indices()
+    except Exception as e:  # pylint: disable=broad-except
+        logging.error("Could not ensure indices: {} {}", type(e), str(e))
+    finally:
+        # MongoClient is not fork-safe, let worker processes create their own
+        # pylint does not see through lru_cache
+        # pylint: disable=too-many-function-args
+        if db.get_client.cache_info().currsize > 0:
+            db.get_client().close()
+            db.get_client.cache_clear()
+
+
+def _on_worker_setup(instance, **kwargs) -> None:
+    """
+    If the crawl frontier is partitioned (see `ielove.frontier`), makes the
+    worker consume the queues of its node, e.g. `bulk.node1` if it consumes
+    `bulk`. Since queues are consumed in order (see `QUEUES`), each of them
+    comes right after its shared queue.
+    """
+    from ielove import frontier
+
+    if (node := frontier.get_node()) is None:
+        return
+    queues, order = instance.app.amqp.queues, []
+    for name in list(queues.consume_from):
+        order.append(name)
+        if name in frontier.PARTITIONED_QUEUES:
+            queues.add(f"{name}.{node}")
+            order.append(f"{name}.{node}")
+    queues.select(order)
+
+
+def _on_worker_ready(**kwargs) -> None:
+    """Starts the frontier heartbeat, see `ielove.frontier`"""
+    from ielove import frontier
+
+    if frontier.get_node() is not None:
+        frontier.start_heartbeat()
+
+
+def _on_worker_shutdown(**kwargs) -> None:
+    """Unregisters the worker from the frontier, see `ielove.frontier`"""
+    from ielove import frontier
+
+    frontier.stop_heartbeat()
+
+
+def _on_task_prerun(task_id: str, task, **kwargs) -> None:
+    """Starts timing (and possibly profiling) a task"""
+    from ielove import metrics
+
+    stack = ExitStack()
+    stack.enter_context(metrics.profiled(task.name))
+    _running_tasks[task_id] = (perf_counter(), stack)
+
 
+def _on_task_postrun(task_id: str, task, **kwargs) -> None:
+    """Stops timing (and possibly profiling) a task"""
+    from ielove import metrics
 
-app = get_app()
+    if task_id not in _running_tasks:
+        return
+    start, stack = _running_tasks.pop(task_id)
+    stack.close()
+    metrics.TASK_SECONDS.labels(task.name).observe(perf_counter() - start)
@@ -0,0 +1,63 @@
+"""
+Regions and property types of ielove.co.jp. Kept apart from `ielove.ielove`
+so that they can be used without importing the scraping dependencies (e.g. by
+the webui at startup).
+"""
+
+ALL_REGIONS = [
+    "aichi",
+    "akita",
+    "aomori",
+    "chiba",
+    "ehime",
+    "fukui",
+    "fukuoka",
+    "fukushima",
+    "gifu",
+    "gunma",
+    "hiroshima",
+    "hokkaido",
+    "hyogo",
+    "ibaraki",
+    "ishikawa",
+    "iwate",
+    "kagawa",
+    "kagoshima",
+    "kanagawa",
+    "kochi",
+    "kumamoto",
+    "kyoto",
+    "mie",
+    "miyagi",
+    "miyazaki",
+    "nagano",
+    "nagasaki",
+    "nara",
+    "niigata",
+    "oita",
+    "okayama",
+    "osaka",
+    "saga",
+    "saitama",
+    "shiga",
+    "shimane",
+    "shizuoka",
+    "tochigi",
+    "tokushima",
+    "tokyo",
+    "tottori",
+    "toyama",
+    "wakayama",
+    "yamagata",
+    "yamaguchi",
+    "yamanashi",
+]
+
+ALL_PROPERTY_TYPES = [
+    "chintai",
+    "kodate_chuko",
+    "kodate_shinchiku",
+    "mansion_chuko",
+    "mansion_shinchiku",
+    "tochi",
+]
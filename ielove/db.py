@@ -1,32 +1,188 @@
 """Database related stuff"""
 
 import os
+from datetime import datetime
+from functools import lru_cache
 from typing import List, Optional
 
 import pymongo
 import regex as re
-from pymongo import MongoClient
+from loguru import logger as logging
+from pymongo import IndexModel, MongoClient
 from pymongo.collection import Collection
+from pymongo.database import Database
 
 from ielove.utils import url_or_pid_to_pid
 
+COLLECTION_OPTIONS = {
+    "properties_archive": {
+        "storageEngine": {
+            "wiredTiger": {"configString": "block_compressor=zstd"}
+        }
+    },
+}
+"""
+Options of the collections that need some, see `ensure_indices`. They only
+apply when the collection is created.
+"""
+
+INDICES = {
+    "floor_plans": [
+        IndexModel([("url", pymongo.ASCENDING)], name="url", unique=True),
+    ],
+    "properties": [
+        IndexModel([("pid", pymongo.ASCENDING)], name="pid", unique=True),
+        IndexModel([("$**", pymongo.TEXT)], name="text"),
+        IndexModel([("location.geo", pymongo.GEO2D)], name="location"),
+        IndexModel(
+            [("details.物件管理番号", pymongo.ASCENDING)],
+            name="details.物件管理番号",
+        ),
+        IndexModel([("details.住所", pymongo.ASCENDING)], name="details.住所"),
+        IndexModel([("last_seen", pymongo.ASCENDING)], name="last_seen"),
+    ],
+    "properties_archive": [
+        IndexModel([("pid", pymongo.ASCENDING)], name="pid", unique=True),
+    ],
+    "stats": [
+        IndexModel(
+            [
+                ("type", pymongo.ASCENDING),
+                ("prefecture", pymongo.ASCENDING),
+                ("city", pymongo.ASCENDING),
+                ("ward", pymongo.ASCENDING),
+            ],
+            name="type_prefecture_city_ward",
+            unique=True,
+        ),
+    ],
+    "results": [
+        IndexModel(
+            [
+                ("type", pymongo.ASCENDING),
+                ("region", pymongo.ASCENDING),
+                ("idx", pymongo.ASCENDING),
+            ],
+            name="type_region_idx",
+        ),
+    ],
+    "tombstones": [
+        IndexModel([("pid", pymongo.ASCENDING)], name="pid", unique=True),
+    ],
+}
+"""Indices of every collection, see `ensure_indices`"""
+
+QUERY_SHAPES = [
+    ("floor_plans", {"url": ""}, None),
+    ("properties", {"pid": ""}, None),
+    ("properties", {"pid": {"$in": [""]}}, None),
+    ("properties", {"details.物件管理番号": 0}, None),
+    ("properties", {"$text": {"$search": ""}}, None),
+    (
+        "properties",
+        {
+            "$or": [
+                {"last_seen": {"$lt": datetime.now()}},
+                {"last_seen": None, "datetime": {"$lt": datetime.now()}},
+            ]
+        },
+        None,
+    ),
+    (
+        "properties",
+        {"details.住所": {"$regex": ".*.*"}},
+        [("details.住所", pymongo.ASCENDING)],
+    ),
+    ("results", {"type": "", "region": "", "idx": 1}, None),
+    ("stats", {"type": "", "prefecture": "", "city": "", "ward": ""}, None),
+    ("stats", {"type": ""}, [("prefecture", 1), ("city", 1), ("ward", 1)]),
+    ("tombstones", {"pid": ""}, None),
+    ("tombstones", {"pid": {"$in": [""]}}, None),
+]
+"""
+Shapes (collection, filter, sort) of all the queries issued by this package,
+see `check_queries`. Keep it in sync when adding new queries!
+"""
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    """Lists all the stages of a query plan (see `check_queries`)"""
+    stages = [plan["stage"]] if "stage" in plan else []
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child is not None:
+            stages += _plan_stages(child)
+    return stages
+
+
+def check_queries() -> List[dict]:
+    """
+    Explains every query shape of `QUERY_SHAPES`, and returns a list of dicts
+    with keys `collection`, `filter`, `sort`, `stages` (stages of the winning
+    plan), and `collscan` (whether the plan does a collection scan).
+    """
+    results = []
+    for name, filter_, sort in QUERY_SHAPES:
+        cursor = get_collection(name).find(filter_)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = _plan_stages(plan)
+        results.append(
+            {
+                "collection": name,
+                "filter": filter_,
+                "sort": sort,
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages,
+            }
+        )
+    return results
+
 
 def ensure_indices():
-    """Ensures that search indices exist"""
-    collection = get_collection("properties")
-    indices = [  # name, field, type, kwargs
-        ("pid", "pid", pymongo.ASCENDING, {"unique": True}),
-        ("text", "$**", pymongo.TEXT, {}),
-        ("location", "location.geo", pymongo.GEO2D, {}),
-    ]
-    info = collection.index_information()
-    for a, b, c, d in indices:
-        if a not in info:
-            collection.create_index([(b, c)], name=a, **d)
+    """
+    Ensures that the collections of `COLLECTION_OPTIONS` and the indices of
+    `INDICES` exist. Indices are identified by name, so existing ones are left
+    untouched.
+    """
+    database = get_database()
+    existing = database.list_collection_names()
+    for name, options in COLLECTION_OPTIONS.items():
+        if name not in existing:
+            logging.info("Creating collection '{}'", name)
+            database.create_collection(name, **options)
+    for name, indices in INDICES.items():
+        collection = get_collection(name)
+        info = collection.index_information()
+        missing = [i for i in indices if i.document["name"] not in info]
+        if missing:
+            logging.info(
+                "Creating indices {} on collection '{}'",
+                [i.document["name"] for i in missing],
+                name,
+            )
+            collection.create_indexes(missing)
 
 
 def get_collection(collection: str = "properties") -> Collection:
-    """Returns a collection handler (under database `ielove`)"""
+    """Returns a collection handler (see `get_database`)"""
+    return get_database()[collection]
+
+
+def get_database() -> Database:
+    """
+    Returns the database handler. Its name is set by the `MONGO_DB`
+    environment variable (default: `ielove`).
+    """
+    return get_client()[os.environ.get("MONGO_DB", "ielove")]
+
+
+@lru_cache(maxsize=1)
+def get_client() -> MongoClient:
+    """
+    Returns the MongoDB client. It is created on first call, and then reused
+    (along with its connection pool).
+    """
     user, pswd = os.environ.get("MONGO_USER"), os.environ.get("MONGO_PASSWORD")
     host = os.environ.get("MONGO_HOST", "localhost")
     port = os.environ.get("MONGO_PORT", "27017")
@@ -36,8 +192,15 @@ def get_collection(collection: str = "properties") -> Collection:
             "MONGO_PASSWORD environment variables"
         )
     uri = f"mongodb://{user}:{pswd}@{host}:{port}/"
-    client: MongoClient = MongoClient(uri)
-    return client["ielove"][collection]
+    return MongoClient(uri)
+
+
+def get_floor_plan(url: str) -> Optional[dict]:
+    """
+    Returns a floor plan document (see `ielove.tasks.scrape_floor_plan`), or
+    `None` if it has not been downloaded yet
+    """
+    return get_collection("floor_plans").find_one({"url": url})
 
 
 def get_property(key: str) -> Optional[dict]:
@@ -56,6 +219,19 @@ def get_property(key: str) -> Optional[dict]:
     return collection.find_one({"pid": key})
 
 
+def search_properties_by_address(text: str, limit: int = 50) -> List[dict]:
+    """
+    Returns the properties whose address contains `text`, sorted by address
+    """
+    collection = get_collection("properties")
+    results = collection.find(
+        {"details.住所": {"$regex": f".*{text}.*"}},
+        sort=[("details.住所", pymongo.ASCENDING)],
+        limit=limit,
+    )
+    return list(results)
+
+
 def search_properties(text: str, limit: int = 20) -> List[dict]:
     """Full-text search against the collection of all properties"""
     collection = get_collection("properties")
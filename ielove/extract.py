@@ -0,0 +1,91 @@
+"""
+Declarative extraction of data from parsed HTML pages. A page kind is
+described by a `Spec`, i.e. a list of `Field`s, each made of a selector and an
+extractor. Specs are compiled once into a lookup table, and all fields of a
+page are then extracted in a single walk over the parsed tree.
+
+Every extraction records, for each field, whether it was found (hit) or not
+(miss) in the `ielove_extracted_fields` metric. A rising miss rate usually
+means that the site changed its markup.
+"""
+
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+import bs4
+
+from ielove.metrics import EXTRACTED_FIELDS
+
+
+class Field(NamedTuple):
+    """
+    A field to extract.
+
+    Attributes:
+        name (str): Key of the field in the extracted data
+        selector (str): Of the form `tag.class`, e.g. `h1.some-class`. Matches
+            all tags with that name having that class (among others).
+        extractor (Callable[[bs4.element.Tag], Any]): Called on every
+            matching tag. If it returns `None`, the tag is ignored.
+        many (bool): If `False`, the value of the field is the first non-`None`
+            value returned by the extractor (or `None` if there are none). If
+            `True`, it is the list of all of them.
+    """
+
+    name: str
+    selector: str
+    extractor: Callable[[bs4.element.Tag], Any]
+    many: bool = False
+
+
+class Spec:
+    """A compiled list of `Field`s, see module documentation"""
+
+    fields: List[Field]
+    kind: str
+    _index: Dict[Tuple[str, str], List[Field]]  # (tag, class) -> fields
+
+    def __init__(self, kind: str, fields: List[Field]) -> None:
+        """
+        Args:
+            kind (str): Page kind, e.g. `property_page`. Used as label in the
+                metrics.
+            fields (List[Field]):
+        """
+        self.kind, self.fields = kind, fields
+        self._index = defaultdict(list)
+        for field in fields:
+            tag, cls = field.selector.split(".", 1)
+            self._index[(tag, cls)].append(field)
+
+    def extract(self, soup: bs4.element.Tag) -> Dict[str, Any]:
+        """
+        Extracts all fields in a single walk over the tree. Returns a dict
+        mapping field names to values (see `Field`).
+        """
+        data: Dict[str, Any] = {
+            f.name: [] if f.many else None for f in self.fields
+        }
+        for tag in soup.descendants:
+            if not isinstance(tag, bs4.element.Tag):
+                continue
+            for cls in tag.get("class") or []:
+                for field in self._index.get((tag.name, cls), []):
+                    if not field.many and data[field.name] is not None:
+                        continue
+                    value = field.extractor(tag)
+                    if value is None:
+                        continue
+                    if field.many:
+                        data[field.name].append(value)
+                    else:
+                        data[field.name] = value
+        for field in self.fields:
+            if field.many:
+                hit = bool(data[field.name])
+            else:
+                hit = data[field.name] is not None
+            EXTRACTED_FIELDS.labels(
+                self.kind, field.name, "hit" if hit else "miss"
+            ).inc()
+        return data
@@ -0,0 +1,255 @@
+"""
+Partitioning of the crawl frontier across worker nodes. Each (property type,
+region) pair is assigned to a node by consistent hashing, and its result page
+and property page tasks are sent to that node's own queues (e.g.
+`discovery.node1` and `bulk.node1`, see `queue`). The in-process caches of
+the workers of that node (see `LocalCache`) therefore always see the same
+partitions and stay warm.
+
+Partitioning is enabled on a worker by setting the `IELOVE_NODE` environment
+variable to a name that is unique to its host (several workers of a host may
+share it). The worker then consumes the queues of that node in addition to the
+shared ones, and announces itself by writing a heartbeat in Redis every
+`HEARTBEAT_INTERVAL` seconds. When a node joins or leaves, the hash ring
+changes and only the partitions of that node move. When the last worker of a
+node stops, it moves the tasks left in the node's queues back to the shared
+queues (see `stop_heartbeat`). If a node stops sending heartbeats, the other
+nodes do it instead (see `rebalance`).
+
+If no node is alive (e.g. partitioning is not used), tasks go to the shared
+queues.
+"""
+
+import bisect
+import os
+import socket
+import threading
+from hashlib import md5
+from time import monotonic, sleep, time
+from typing import Any, Dict, Generic, List, Optional, Tuple, TypeVar, cast
+
+from loguru import logger as logging
+from redis.exceptions import RedisError
+
+from ielove.celery import VISIBILITY_TIMEOUT, get_redis
+
+HEARTBEAT_INTERVAL = 30
+"""In seconds"""
+
+NODE_TIMEOUT = 3 * HEARTBEAT_INTERVAL
+"""A node is dead if its last heartbeat is older than this (in seconds)"""
+
+PARTITIONED_QUEUES = ["discovery", "bulk"]
+
+NODES_KEY = "ielove:nodes"
+"""Sorted set of node names, scored by the time of their last heartbeat"""
+
+WORKERS_KEY = "ielove:nodes:{}:workers"
+"""
+Sorted set of the workers of a node (see `_worker_id`), scored by the time of
+their last heartbeat
+"""
+
+VIRTUAL_NODES = 64
+"""Number of points of each node on the hash ring"""
+
+T = TypeVar("T")
+
+
+class LocalCache(Generic[T]):
+    """
+    A small in-process cache with expiry, for data that is local to a
+    partition (e.g. result page counts, recently scraped pids). It is not
+    shared between the processes of a node: with a prefork pool, each child
+    process has its own (empty at first) copy.
+    """
+
+    max_size: int
+    ttl: float
+    _data: Dict[Any, Tuple[float, T]]  # key -> (expiry, value)
+
+    def __init__(self, ttl: float, max_size: int = 100000) -> None:
+        self.max_size, self.ttl, self._data = max_size, ttl, {}
+
+    def get(self, key: Any) -> Optional[T]:
+        """Returns the cached value, or `None` if absent or expired"""
+        if (item := self._data.get(key)) is None:
+            return None
+        if item[0] < monotonic():
+            del self._data[key]
+            return None
+        return item[1]
+
+    def set(self, key: Any, value: T) -> None:
+        """Caches a value. If the cache is full, it is emptied first."""
+        if len(self._data) >= self.max_size:
+            self._data.clear()
+        self._data[key] = (monotonic() + self.ttl, value)
+
+
+_ring: Optional[Tuple[float, List[Tuple[int, str]]]] = None
+"""Hash ring and the time it was built at"""
+
+
+def _hash(x: str) -> int:
+    """Position on the hash ring"""
+    return int(md5(x.encode("utf-8")).hexdigest()[:16], 16)
+
+
+def _get_ring() -> List[Tuple[int, str]]:
+    """
+    Returns the hash ring of the live nodes, as a sorted list of (position,
+    node) pairs. The ring is rebuilt at most every few seconds.
+    """
+    global _ring  # pylint: disable=global-statement
+    if _ring is None or monotonic() - _ring[0] > 10:
+        ring = []
+        for node in live_nodes():
+            ring += [
+                (_hash(f"{node}#{i}"), node) for i in range(VIRTUAL_NODES)
+            ]
+        _ring = (monotonic(), sorted(ring))
+    return _ring[1]
+
+
+def get_node() -> Optional[str]:
+    """Name of the current node, or `None` if partitioning is disabled"""
+    return os.environ.get("IELOVE_NODE")
+
+
+def _worker_id() -> str:
+    """Identifies the current worker among those of its node"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _move_tasks(node: str) -> int:
+    """
+    Moves the tasks left in the queues of a node to the shared queues, and
+    returns their number
+    """
+    r, n = get_redis(), 0
+    # The Redis transport has one list per queue and priority, see
+    # ielove.celery.get_app
+    suffixes = [""] + [f":{p}" for p in range(1, 10)]
+    for name in PARTITIONED_QUEUES:
+        for s in suffixes:
+            while r.rpoplpush(f"{name}.{node}{s}", f"{name}{s}"):
+                n += 1
+    return n
+
+
+def heartbeat() -> None:
+    """Announces that the current worker, and therefore its node, is alive"""
+    if (node := get_node()) is not None:
+        now, key = time(), WORKERS_KEY.format(node)
+        pipeline = get_redis().pipeline()
+        pipeline.zadd(NODES_KEY, {node: now})
+        pipeline.zadd(key, {_worker_id(): now})
+        pipeline.zremrangebyscore(key, "-inf", now - NODE_TIMEOUT)
+        pipeline.execute()
+
+
+def live_nodes() -> List[str]:
+    """
+    Names of the nodes that sent a heartbeat recently. Returns an empty list
+    if Redis is unreachable.
+    """
+    try:
+        nodes = cast(
+            List[bytes],
+            get_redis().zrangebyscore(
+                NODES_KEY, time() - NODE_TIMEOUT, "+inf"
+            ),
+        )
+    except RedisError as e:
+        logging.debug("Could not list nodes: {}", e)
+        return []
+    return [n.decode("utf-8") for n in nodes]
+
+
+def node_for(property_type: str, region: str) -> Optional[str]:
+    """
+    Node owning a (property type, region) partition, or `None` if no node is
+    alive
+    """
+    if not (ring := _get_ring()):
+        return None
+    i = bisect.bisect(ring, (_hash(f"{property_type}/{region}"), ""))
+    return ring[i % len(ring)][1]
+
+
+def queue(name: str, property_type: str, region: str) -> str:
+    """
+    Queue to which a task of a (property type, region) partition should be
+    sent, e.g. `discovery.node1`. If no node is alive, returns the shared
+    queue `name`.
+
+    Args:
+        name (str): Either `discovery` or `bulk`
+        property_type (str):
+        region (str):
+    """
+    node = node_for(property_type, region)
+    return name if node is None else f"{name}.{node}"
+
+
+def rebalance() -> None:
+    """
+    Moves the tasks left in the queues of dead nodes to the shared queues.
+    Tasks may still be sent to a dead node until all rings are rebuilt (see
+    `_get_ring`), and the tasks it had reserved are put back into its queues
+    only after `ielove.celery.VISIBILITY_TIMEOUT`. Dead nodes are therefore
+    forgotten only after that delay.
+    """
+    r, now = get_redis(), time()
+    dead = cast(
+        List[Tuple[bytes, float]],
+        r.zrangebyscore(
+            NODES_KEY, "-inf", now - NODE_TIMEOUT, withscores=True
+        ),
+    )
+    for node, last_seen in [(n.decode("utf-8"), t) for n, t in dead]:
+        if n := _move_tasks(node):
+            logging.info("Node '{}' is dead, moved {} of its tasks", node, n)
+        if last_seen < now - NODE_TIMEOUT - VISIBILITY_TIMEOUT:
+            r.zrem(NODES_KEY, node)
+            r.delete(WORKERS_KEY.format(node))
+
+
+def start_heartbeat() -> None:
+    """
+    Starts a daemon thread that sends heartbeats (see `heartbeat`) and
+    rebalances tasks of dead nodes (see `rebalance`)
+    """
+
+    def _loop() -> None:
+        while True:
+            try:
+                heartbeat()
+                rebalance()
+            except RedisError as e:
+                logging.warning("Frontier heartbeat failed: {}", e)
+            sleep(HEARTBEAT_INTERVAL)
+
+    threading.Thread(target=_loop, daemon=True, name="heartbeat").start()
+
+
+def stop_heartbeat() -> None:
+    """
+    Unregisters the current worker, e.g. at shutdown. If it was the last live
+    worker of its node, the node is marked as dead and the tasks left in its
+    queues are moved to the shared queues. Other nodes may still send tasks
+    to it until their ring is rebuilt (see `_get_ring`); these are moved by
+    `rebalance`.
+    """
+    global _ring  # pylint: disable=global-statement
+    if (node := get_node()) is None:
+        return
+    r, key = get_redis(), WORKERS_KEY.format(node)
+    r.zrem(key, _worker_id())
+    if cast(int, r.zcount(key, time() - NODE_TIMEOUT, "+inf")) > 0:
+        return  # Other workers of this node are still alive
+    r.zadd(NODES_KEY, {node: time() - NODE_TIMEOUT})
+    _ring = None
+    n = _move_tasks(node)
+    logging.info("Node '{}' stopped, moved {} of its tasks", node, n)
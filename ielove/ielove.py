@@ -1,78 +1,44 @@
 """Page scraping"""
 
-from base64 import b64encode
+import os
 from datetime import datetime
-from typing import Any, Dict
+from typing import Any, Dict, Iterator, List, Optional
 from urllib.parse import parse_qs, urlparse
 
 import bs4
 import regex as re
-import requests
 from loguru import logger as logging
 
+from ielove.constants import (  # pylint: disable=unused-import
+    ALL_PROPERTY_TYPES,
+    ALL_REGIONS,
+)
+from ielove.extract import Field, Spec
+from ielove.metrics import EXTRACTED_FIELDS, timed
 from ielove.utils import (
     all_tag_contents,
+    fetch,
+    fetch_stream,
     get_soup,
+    make_thumbnail,
     process_string,
 )
 
-ALL_REGIONS = [
-    "aichi",
-    "akita",
-    "aomori",
-    "chiba",
-    "ehime",
-    "fukui",
-    "fukuoka",
-    "fukushima",
-    "gifu",
-    "gunma",
-    "hiroshima",
-    "hokkaido",
-    "hyogo",
-    "ibaraki",
-    "ishikawa",
-    "iwate",
-    "kagawa",
-    "kagoshima",
-    "kanagawa",
-    "kochi",
-    "kumamoto",
-    "kyoto",
-    "mie",
-    "miyagi",
-    "miyazaki",
-    "nagano",
-    "nagasaki",
-    "nara",
-    "niigata",
-    "oita",
-    "okayama",
-    "osaka",
-    "saga",
-    "saitama",
-    "shiga",
-    "shimane",
-    "shizuoka",
-    "tochigi",
-    "tokushima",
-    "tokyo",
-    "tottori",
-    "toyama",
-    "wakayama",
-    "yamagata",
-    "yamaguchi",
-    "yamanashi",
-]
-
-ALL_PROPERTY_TYPES = [
-    "chintai",
-    "kodate_chuko",
-    "kodate_shinchiku",
-    "mansion_chuko",
-    "mansion_shinchiku",
-    "tochi",
-]
+BASE_URL = os.environ.get("IELOVE_BASE_URL", "https://www.ielove.co.jp")
+"""
+Root URL of the site. Only meant to be changed to point to a stand-in server,
+see `ielove.loadtest`.
+"""
+
+_PROPERTY_LINK = re.compile(
+    r"<a\s[^>]*(?<![\w-])result-panel-room__inner(?![\w-])[^>]*>"
+)
+"""Opening tag of a `a.result-panel-room__inner`, see `stream_result_page`"""
+
+_HREF = re.compile(r'\bhref="([^"]+)"')
+
+_RESULT_LIST_END = 'id="pagerParams"'
+"""Marks the end of the property list in a result page"""
 
 
 def last_result_page_idx(url: str) -> int:
@@ -100,10 +66,8 @@ def last_result_page_idx(url: str) -> int:
     headers = {
         "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"
     }
-    url = "https://www.ielove.co.jp/bkn/ajax/count/"
-    logging.debug("POST {}", url)
-    response = requests.post(url, headers=headers, data=data, timeout=20)
-    response.raise_for_status()
+    url = f"{BASE_URL}/bkn/ajax/count/"
+    response = fetch("post", url, headers=headers, data=data)
     html = response.json()["pcPager"]
     soup = bs4.BeautifulSoup(html, "html.parser")
     cnts = all_tag_contents(soup)
@@ -111,13 +75,101 @@ def last_result_page_idx(url: str) -> int:
     return sorted(cnts)[-1]
 
 
-# pylint: disable=too-many-locals
+def _extract_details(tag: bs4.element.Tag) -> Dict[str, Any]:
+    """Extracts the key/value pairs of a `div.detail-bkninfo__block`"""
+    details: Dict[str, Any] = {}
+    hs = tag.find_all(name="dt", class_="detail-bkninfo__head")
+    ts = tag.find_all(name="dd", class_="detail-bkninfo__txt")
+    for h, t in zip(hs, ts):
+        hc, tc = process_string(h.contents[0]), all_tag_contents(t)
+        if len(tc) == 0:
+            details[hc] = None
+        elif len(tc) == 1:
+            details[hc] = tc[0]
+        else:
+            details[hc] = " ".join(map(str, tc))
+    return details
+
+
+def _extract_floor_plan(tag: bs4.element.Tag) -> Optional[Dict[str, Any]]:
+    """Extracts the URL of a `img.detail-thumbimage__img` if it's a 間取り"""
+    if "間取り" in tag.get("alt", ""):
+        return {"url": tag["src"]}
+    return None
+
+
+def _extract_geo(tag: bs4.element.Tag) -> Optional[List[float]]:
+    """Extracts the coordinates of a `div.detail-spot__map`"""
+    if tag.iframe is None:
+        return None
+    r = r"q=(\d+\.\d+),(\d+\.\d+)&"
+    if m := re.search(r, tag.iframe.get("data-src", "")):
+        return [float(m.group(1)), float(m.group(2))]
+    return None
+
+
+def _extract_property_link(tag: bs4.element.Tag) -> Dict[str, Any]:
+    """Extracts a property from a `a.result-panel-room__inner`"""
+    return _property_link(tag["href"])
+
+
+def _property_link(href: str) -> Dict[str, Any]:
+    """
+    Pid, type, and URL of a property from the path of its page, e.g.
+    `/chintai/c1-397758400/`
+    """
+    path_parts = href.split("/")
+    return {
+        "pid": path_parts[2],
+        "type": path_parts[1],
+        "url": BASE_URL + href,
+    }
+
+
+def _extract_first_string(tag: bs4.element.Tag) -> Any:
+    """Processed first content of a tag (see `ielove.utils.process_string`)"""
+    return process_string(tag.contents[0]) if tag.contents else None
+
+
+PROPERTY_PAGE_SPEC = Spec(
+    "property_page",
+    [
+        Field(
+            "name", "h1.detail-summary__tatemononame", _extract_first_string
+        ),
+        Field("salespoint", "p.detail-salespoint__txt", _extract_first_string),
+        Field(
+            "details", "div.detail-bkninfo__block", _extract_details, many=True
+        ),
+        Field("geo", "div.detail-spot__map", _extract_geo),
+        Field("floor_plan", "img.detail-thumbimage__img", _extract_floor_plan),
+    ],
+)
+"""Fields of a property page, see `scrape_property_page`"""
+
+RESULT_PAGE_SPEC = Spec(
+    "result_page",
+    [
+        Field(
+            "properties",
+            "a.result-panel-room__inner",
+            _extract_property_link,
+            many=True,
+        ),
+    ],
+)
+"""Fields of a result page, see `scrape_result_page`"""
+
+
 def scrape_property_page(url: str) -> Dict[str, Any]:
     """
     Scrapes a property page page, e.g.
 
         https://www.ielove.co.jp/chintai/c1-397758400
         https://www.ielove.co.jp/mansion_shinchiku/b1-404543984/
+
+    The floor plan image is not downloaded, only its URL is recorded under
+    `floor_plan.url`. See `scrape_floor_plan`.
     """
     soup, u = get_soup(url), urlparse(url)
 
@@ -131,63 +183,52 @@ def scrape_property_page(url: str) -> Dict[str, Any]:
 
     logging.info("Scraping {} page id '{}'", data["type"], data["pid"])
 
-    if tag := soup.find(
-        name="h1", class_="detail-summary__tatemononame ui-font--size_h1"
-    ):
-        data["name"] = process_string(tag.contents[0])
-
-    if tag := soup.find(name="p", class_="detail-salespoint__txt"):
-        data["salespoint"] = process_string(tag.contents[0])
-
-    data["details"] = {}
-    for tag in soup.find_all(name="div", class_="detail-bkninfo__block"):
-        hs = tag.find_all(name="dt", class_="detail-bkninfo__head")
-        ts = tag.find_all(name="dd", class_="detail-bkninfo__txt")
-        for h, t in zip(hs, ts):
-            hc, tc = process_string(h.contents[0]), all_tag_contents(t)
-            if len(tc) == 0:
-                data["details"][hc] = None
-            elif len(tc) == 1:
-                data["details"][hc] = tc[0]
-            else:
-                data["details"][hc] = " ".join(map(str, tc))
-
-    data["location"] = {}
-    if tag := soup.find(name="div", class_="detail-spot__map"):
-        if m := re.search(r"q=(\d+\.\d+),(\d+\.\d+)&", tag.iframe["data-src"]):
-            data["location"]["geo"] = [float(m.group(1)), float(m.group(2))]
-    if "住所" in data["details"]:
-        r = r"(\w+[都道府県])?\s*(\w+[市町村])?\s*(\w+[区])?\s*(.*?)\s*(?:地図)?$"
-        if m := re.search(r, data["details"]["住所"]):
-            _f = lambda x: x if x else "-"
-            a, b, c, d = m.groups()
-            a, b, c, d = _f(a), _f(b), _f(c), _f(d)
-            data["location"]["prefecture"] = a
-            data["location"]["city"] = b
-            data["location"]["ward"] = c
-            data["location"]["address"] = d
-            data["details"]["住所"] = f"{a} {b} {c} {d}"
-
-    for tag in soup.find_all(name="img", class_="detail-thumbimage__img"):
-        if "間取り" not in tag["alt"]:
-            continue
-        try:
-            response = requests.get(tag["src"], timeout=10)
-            response.raise_for_status()
-            data["floor_plan"] = {
-                "url": tag["src"],
-                "img": b64encode(response.content),
-            }
-        except requests.exceptions.RequestException as e:
-            logging.error(
-                f"Could not get floor plan for property id {data['pid']} "
-                f"({data['url']}): {type(e)} {str(e)}"
-            )
-        break
+    with timed("normalize"):
+        fields = PROPERTY_PAGE_SPEC.extract(soup)
+        for k in ["name", "salespoint", "floor_plan"]:
+            if fields[k] is not None:
+                data[k] = fields[k]
+
+        data["details"] = {}
+        for details in fields["details"]:
+            data["details"].update(details)
+
+        data["location"] = {}
+        if fields["geo"] is not None:
+            data["location"]["geo"] = fields["geo"]
+        if "住所" in data["details"]:
+            r = r"(\w+[都道府県])?\s*(\w+[市町村])?\s*(\w+[区])?\s*(.*?)\s*(?:地図)?$"
+            if m := re.search(r, data["details"]["住所"]):
+                _f = lambda x: x if x else "-"
+                a, b, c, d = m.groups()
+                a, b, c, d = _f(a), _f(b), _f(c), _f(d)
+                data["location"]["prefecture"] = a
+                data["location"]["city"] = b
+                data["location"]["ward"] = c
+                data["location"]["address"] = d
+                data["details"]["住所"] = f"{a} {b} {c} {d}"
 
     return data
 
 
+def scrape_floor_plan(url: str) -> Dict[str, Any]:
+    """
+    Downloads a floor plan image and makes a WebP thumbnail of it (see
+    `ielove.utils.make_thumbnail`). The original image is not kept, it can be
+    fetched from `url` when needed.
+    """
+    logging.info("Scraping floor plan '{}'", url)
+    with timed("floor_plan"):
+        response = fetch("get", url, timeout=10)
+        thumbnail = make_thumbnail(response.content)
+    return {
+        "url": url,
+        "datetime": datetime.now(),
+        "size": len(response.content),
+        "thumbnail": thumbnail,
+    }
+
+
 def scrape_result_page(url: str) -> Dict[str, Any]:
     """
     Scrapes all ids from a chintai result page, e.g.
@@ -197,23 +238,43 @@ def scrape_result_page(url: str) -> Dict[str, Any]:
     """
     logging.info("Scraping property result page '{}'", url)
     soup = get_soup(url)
-    data = {
-        "datetime": datetime.now(),
-        "properties": [],
-        **result_page_metadata(url),
-    }
-    for tag in soup.find_all(name="a", class_="result-panel-room__inner"):
-        path_parts = tag["href"].split("/")
-        data["properties"].append(
-            {
-                "pid": path_parts[2],
-                "type": path_parts[1],
-                "url": "https://www.ielove.co.jp" + tag["href"],
-            }
-        )
+    data = {"datetime": datetime.now(), **result_page_metadata(url)}
+    with timed("normalize"):
+        data["properties"] = RESULT_PAGE_SPEC.extract(soup)["properties"]
     return data
 
 
+def stream_result_page(url: str) -> Iterator[Dict[str, Any]]:
+    """
+    Lightweight version of `scrape_result_page`: yields the properties of a
+    result page (as dicts with keys `pid`, `type`, and `url`) as soon as they
+    are downloaded. The page is not parsed into a tree, the property links are
+    found by pattern matching, and the download stops at the end of the
+    property list, so the pager, footer, and scripts are never fetched.
+    """
+    logging.info("Streaming property result page '{}'", url)
+    chunks, buffer, n = fetch_stream("get", url), "", 0
+    try:
+        for chunk in chunks:
+            buffer += chunk
+            with timed("parse"):
+                matches = list(_PROPERTY_LINK.finditer(buffer))
+            end = matches[-1].end() if matches else 0
+            for m in matches:
+                if h := _HREF.search(m.group(0)):
+                    n += 1
+                    yield _property_link(h.group(1))
+            if n > 0 and _RESULT_LIST_END in buffer[end:]:
+                break
+            # Keeps enough to complete a tag cut between two chunks
+            buffer = buffer[end:][-4096:]
+    finally:
+        chunks.close()
+    EXTRACTED_FIELDS.labels(
+        "result_page", "properties", "hit" if n > 0 else "miss"
+    ).inc()
+
+
 def result_page_metadata(url: str) -> dict:
     """
     Returns a few metadata that can be obtained just from the result page url:
@@ -0,0 +1,86 @@
+"""
+In-flight task deduplication. Before a scraping task is enqueued, a lease is
+taken on its key in Redis (`SET NX` with an expiry). Enqueuing is skipped if
+the lease is already held, i.e. if the same page is already queued or being
+scraped. The value of a lease is a token, namely the id of the task that
+holds it. The task releases the lease when it is done, otherwise it expires
+after `IELOVE_LEASE_TTL` seconds (default: one day). A task that does not
+hold the lease of its page (e.g. one submitted by hand, see
+`ielove.celery.INTERACTIVE`) leaves it untouched.
+"""
+
+import os
+from hashlib import sha1
+from typing import Iterable, List, Optional, Tuple
+
+from ielove.celery import get_redis
+from ielove.metrics import DUPLICATES_SUPPRESSED
+
+PREFIX = "ielove:lease:"
+
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+"""Deletes a lease if it is held by the given token"""
+
+
+def _ttl() -> int:
+    """Lease expiry in seconds"""
+    return int(os.environ.get("IELOVE_LEASE_TTL", str(24 * 60 * 60)))
+
+
+def floor_plan_key(url: str) -> str:
+    """Lease key of a floor plan image"""
+    return "floor_plan:" + sha1(url.encode("utf-8")).hexdigest()
+
+
+def property_page_key(pid: str) -> str:
+    """Lease key of a property page"""
+    return f"property:{pid}"
+
+
+def result_page_key(meta: dict) -> str:
+    """
+    Lease key of a result page, given its metadata (see
+    `ielove.ielove.result_page_metadata`)
+    """
+    return f"result:{meta['type']}:{meta['region']}:{meta['idx']}"
+
+
+def acquire(key: str, token: str) -> bool:
+    """
+    Tries to take the lease on `key` for `token` (e.g. the id of the task to
+    be enqueued). Returns `True` if successful, `False` if the lease is
+    already held.
+    """
+    return acquire_many([(key, token)])[0]
+
+
+def acquire_many(items: Iterable[Tuple[str, str]]) -> List[bool]:
+    """
+    Tries to take the leases on many `(key, token)` pairs in a single
+    round-trip. Returns a list of booleans, see `acquire`.
+    """
+    ttl = _ttl()
+    pipeline = get_redis().pipeline(transaction=False)
+    kinds = []
+    for key, token in items:
+        pipeline.set(PREFIX + key, token, nx=True, ex=ttl)
+        kinds.append(key.split(":", 1)[0])
+    acquired = [bool(r) for r in pipeline.execute()]
+    for kind, a in zip(kinds, acquired):
+        if not a:
+            DUPLICATES_SUPPRESSED.labels(kind).inc()
+    return acquired
+
+
+def release(key: str, token: Optional[str]) -> None:
+    """
+    Releases the lease on `key` if it is held by `token`. Does nothing
+    otherwise, or if `token` is `None`.
+    """
+    if token is not None:
+        get_redis().eval(_RELEASE, 1, PREFIX + key, token)
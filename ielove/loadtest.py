@@ -0,0 +1,659 @@
+"""
+Load testing. Runs the real scraping pipeline (Celery workers running
+`ielove.tasks`) against a local stand-in of ielove.co.jp (see `FakeSite`),
+for a sweep of worker settings (see `Setting`), and reports for each run:
+- the throughput, i.e. the number of properties committed per second;
+- the median and 99th percentile of the run time of property page tasks,
+  estimated from the `ielove_task_seconds` histogram of the workers;
+- the number of queued tasks over time;
+- the number of MongoDB operations (server-wide) and Redis commands per
+  second.
+
+Runs use a dedicated Redis database and a dedicated MongoDB database, which
+are emptied before each run. The latency of Redis and MongoDB, as seen by the
+workers, can be increased to that of a remote server by routing their
+connections through a `LatencyProxy` (MongoDB must then be a standalone
+server, not a replica set).
+
+Tasks that fail because of a 429 or 5xx are retried after at least 30 seconds
+(see `ielove.tasks`), so runs with a non-zero error rate take longer to drain.
+"""
+
+import os
+import random
+import re
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from math import isinf
+from pathlib import Path
+from shutil import which
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    cast,
+)
+from urllib.parse import parse_qs, urlparse
+
+from celery import Celery
+from loguru import logger as logging
+from PIL import Image
+from prometheus_client import CollectorRegistry, multiprocess
+from redis import Redis
+
+from ielove import db, frontier
+from ielove.celery import QUEUES, get_app, get_redis, get_redis_uri
+
+
+class Setting(NamedTuple):
+    """
+    Worker setting of a run.
+
+    Attributes:
+        workers (int): Number of worker processes (`celery worker`)
+        concurrency (int): Number of child processes per worker
+        prefetch (int): Prefetch multiplier
+        min_interval (float): Minimal interval between two requests to the
+            site, in seconds (see `ielove.throttle`). Runs start at that
+            interval.
+    """
+
+    workers: int
+    concurrency: int
+    prefetch: int
+    min_interval: float
+
+
+# pylint: disable=too-many-instance-attributes
+class FakeSite:
+    """
+    Stand-in for ielove.co.jp, serving generated result pages, property
+    pages, floor plan images, and the page count endpoint (see
+    `ielove.ielove.last_result_page_idx`). All regions and property types
+    exist, with the same number of result pages.
+    """
+
+    error_rate: float
+    latency: float
+    listings: int
+    padding: str
+    pages: int
+    retry_after: int
+    throttle_rate: float
+    counters: Counter
+    floor_plan: bytes
+    _lock: threading.Lock
+    _server: Optional[ThreadingHTTPServer]
+
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(
+        self,
+        pages: int = 5,
+        listings: int = 20,
+        latency: float = 0.1,
+        error_rate: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: int = 60,
+        page_size: int = 65536,
+    ) -> None:
+        """
+        Args:
+            pages (int): Number of result pages per region
+            listings (int): Number of properties per result page
+            latency (float): Mean response time in seconds. Response times
+                are exponentially distributed.
+            error_rate (float): Proportion of 503 responses
+            throttle_rate (float): Proportion of 429 responses
+            retry_after (int): `Retry-After` of 429 responses, in seconds
+            page_size (int): Approximate size of HTML pages in bytes, mostly
+                made of scripts around the content
+        """
+        self.pages, self.listings = pages, listings
+        self.latency, self.error_rate = latency, error_rate
+        self.throttle_rate, self.retry_after = throttle_rate, retry_after
+        self.padding = "<script>" + "x" * (page_size // 2) + "</script>"
+        self.counters, self._lock = Counter(), threading.Lock()
+        self._server = None
+        buffer = BytesIO()
+        Image.effect_noise((800, 600), 32).save(buffer, format="PNG")
+        self.floor_plan = buffer.getvalue()
+
+    @property
+    def url(self) -> str:
+        """Root URL of the site, see `ielove.ielove.BASE_URL`"""
+        if self._server is None:
+            raise RuntimeError("The fake site is not started")
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def count(self, status: int, size: int) -> None:
+        """Records a response"""
+        with self._lock:
+            self.counters["requests"] += 1
+            self.counters["bytes"] += size
+            if status >= 400:
+                self.counters["errors"] += 1
+
+    def property_page(self, property_type: str, pid: str) -> str:
+        """HTML code of a property page"""
+        price = "12.5万円" if property_type == "chintai" else "3,480万円"
+        due = time.localtime(time.time() + 14 * 86400)
+        details = {
+            "賃料" if property_type == "chintai" else "価格": price,
+            "専有面積": f"{random.randint(15, 120)}.5㎡",
+            "住所": "東京都 港区 六本木1-2-3",
+            "物件管理番号": pid,
+            "次回更新予定日": f"{due.tm_year}年{due.tm_mon}月{due.tm_mday}日",
+        }
+        rows = "".join(
+            f'<dt class="detail-bkninfo__head">{k}</dt>'
+            f'<dd class="detail-bkninfo__txt">{v}</dd>'
+            for k, v in details.items()
+        )
+        return (
+            f"<html><head>{self.padding}</head><body>"
+            f'<h1 class="detail-summary__tatemononame">Property {pid}</h1>'
+            f'<p class="detail-salespoint__txt">Load test</p>'
+            f'<div class="detail-bkninfo__block"><dl>{rows}</dl></div>'
+            f'<img class="detail-thumbimage__img" alt="間取り図" '
+            f'src="{self.url}/img/{pid}.png">'
+            f"{self.padding}</body></html>"
+        )
+
+    def result_page(self, property_type: str, region: str, idx: int) -> str:
+        """HTML code of a result page"""
+        links = "".join(
+            f'<div class="result-panel-room">'
+            f'<a class="result-panel-room__inner" '
+            f'href="/{property_type}/{property_type}-{region}-{idx}-{i}/">'
+            f"Property {i}</a></div>"
+            for i in range(self.listings)
+        )
+        return (
+            f"<html><head>{self.padding}</head><body>{links}"
+            f'<form id="pagerParams">'
+            f'<input name="type" value="{property_type}">'
+            f'<input name="region" value="{region}">'
+            f"</form>{self.padding}</body></html>"
+        )
+
+    def page_count(self) -> str:
+        """Response of the page count endpoint"""
+        pager = "".join(f"<li>{i}</li>" for i in range(1, self.pages + 1))
+        return '{"pcPager": "<ul>' + pager + '</ul>"}'
+
+    def start(self) -> str:
+        """Starts serving in a background thread, and returns `url`"""
+        handler = type("Handler", (_FakeSiteHandler,), {"site": self})
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True
+        ).start()
+        logging.info("Fake site listening on {}", self.url)
+        return self.url
+
+    def stop(self) -> None:
+        """Self explanatory"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+class _FakeSiteHandler(BaseHTTPRequestHandler):
+    """Request handler of `FakeSite`"""
+
+    site: FakeSite
+
+    def _respond(self, status: int, body: bytes, content_type: str) -> None:
+        """Sends a response and records it"""
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 429:
+            self.send_header("Retry-After", str(self.site.retry_after))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass  # Streamed pages are not always read completely
+        self.site.count(status, len(body))
+
+    def _handle(self) -> None:
+        """Simulates latency and errors, then routes the request"""
+        site = self.site
+        if site.latency > 0:
+            time.sleep(random.expovariate(1 / site.latency))
+        x = random.random()
+        if x < site.throttle_rate:
+            self._respond(429, b"Too Many Requests", "text/plain")
+            return
+        if x < site.throttle_rate + site.error_rate:
+            self._respond(503, b"Service Unavailable", "text/plain")
+            return
+        u = urlparse(self.path)
+        html = "text/html; charset=UTF-8"
+        if self.command == "POST" and u.path == "/bkn/ajax/count/":
+            length = int(self.headers.get("Content-Length", "0"))
+            self.rfile.read(length)
+            body = site.page_count().encode("utf-8")
+            self._respond(200, body, "application/json")
+        elif re.match(r"^/img/[^/]+\.png$", u.path):
+            self._respond(200, site.floor_plan, "image/png")
+        elif m := re.match(r"^/([^/]+)/([^/]+)/result/?$", u.path):
+            idx = int(parse_qs(u.query).get("pg", ["1"])[0])
+            if not 1 <= idx <= site.pages:
+                self._respond(404, b"Not Found", "text/plain")
+                return
+            body = site.result_page(m.group(1), m.group(2), idx).encode()
+            self._respond(200, body, html)
+        elif m := re.match(r"^/([^/]+)/([^/]+)/?$", u.path):
+            body = site.property_page(m.group(1), m.group(2)).encode()
+            self._respond(200, body, html)
+        else:
+            self._respond(404, b"Not Found", "text/plain")
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Self explanatory"""
+        self._handle()
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """Self explanatory"""
+        self._handle()
+
+    def log_message(self, *args) -> None:  # pylint: disable=arguments-differ
+        """Silenced"""
+
+
+class LatencyProxy:
+    """
+    TCP proxy adding a delay to every exchange with a server, to simulate a
+    remote Redis or MongoDB server. Runs in background threads.
+    """
+
+    delay: float
+    port: int
+    target: Tuple[str, int]
+    _server: socket.socket
+
+    def __init__(self, host: str, port: int, delay: float) -> None:
+        """
+        Args:
+            host (str): Host of the proxied server
+            port (int): Port of the proxied server
+            delay (float): Added round-trip time, in seconds
+        """
+        self.target, self.delay = (host, port), delay
+        self._server = socket.create_server(("127.0.0.1", 0))
+        self.port = self._server.getsockname()[1]
+
+    def _accept(self) -> None:
+        """Accepts connections and pipes them to the server"""
+        while True:
+            try:
+                client, _ = self._server.accept()
+            except OSError:
+                return  # Stopped
+            try:
+                upstream = socket.create_connection(self.target)
+            except OSError as e:
+                logging.error(
+                    "Proxy could not connect to {}: {}", self.target, e
+                )
+                client.close()
+                continue
+            for a, b in [(client, upstream), (upstream, client)]:
+                threading.Thread(
+                    target=self._pipe, args=(a, b), daemon=True
+                ).start()
+
+    def _pipe(self, src: socket.socket, dst: socket.socket) -> None:
+        """Forwards data from `src` to `dst`, half of the delay late"""
+        try:
+            while data := src.recv(65536):
+                time.sleep(self.delay / 2)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            for s in [src, dst]:
+                try:
+                    s.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                s.close()
+
+    def start(self) -> int:
+        """Starts proxying, and returns the port of the proxy"""
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self.port
+
+    def stop(self) -> None:
+        """Stops accepting connections"""
+        self._server.close()
+
+
+def _db_ops() -> int:
+    """Number of MongoDB operations served so far, server-wide"""
+    status = db.get_client().admin.command("serverStatus")["opcounters"]
+    return sum(
+        status[k] for k in ["insert", "query", "update", "delete", "getmore"]
+    )
+
+
+def _queue_keys() -> List[str]:
+    """
+    Redis keys of the task queues, one per queue and priority (see
+    `ielove.celery.get_app`)
+    """
+    suffixes = [""] + [f":{p}" for p in range(1, 10)]
+    return [q + s for q in QUEUES for s in suffixes]
+
+
+def _sample(redis: Redis, site: FakeSite, start: float) -> Dict[str, Any]:
+    """State of the pipeline at a point of a run"""
+    pipeline = redis.pipeline()
+    for k in _queue_keys():
+        pipeline.llen(k)
+    pipeline.hlen("unacked")
+    *depths, unacked = pipeline.execute()
+    return {
+        "t": time.monotonic() - start,
+        "queued": sum(depths),
+        "unacked": unacked,
+        "requests": site.counters["requests"],
+        "properties": db.get_collection(
+            "properties"
+        ).estimated_document_count(),
+    }
+
+
+def _redis_commands(redis: Redis) -> int:
+    """Number of commands processed by the Redis server so far"""
+    stats = cast(Dict[str, Any], redis.info("stats"))
+    return int(stats["total_commands_processed"])
+
+
+def _start_workers(
+    setting: Setting, env: Dict[str, str], directory: Path
+) -> List[subprocess.Popen]:
+    """
+    Starts the worker processes of a run. Their logs and metrics go to
+    `directory`.
+    """
+    command = [which("celery") or "celery", "-A", "ielove.tasks", "worker"]
+    processes = []
+    for i in range(setting.workers):
+        # The workers outlive this function, and keep their own copy of log
+        # pylint: disable=consider-using-with
+        with open(directory / f"worker{i}.log", "wb") as log:
+            processes.append(
+                subprocess.Popen(
+                    command
+                    + [
+                        "--concurrency",
+                        str(setting.concurrency),
+                        "--prefetch-multiplier",
+                        str(setting.prefetch),
+                        "--hostname",
+                        f"loadtest{i}@%h",
+                        "--queues",
+                        ",".join(q for q in QUEUES if q != "interactive"),
+                        "--loglevel",
+                        "WARNING",
+                        "--without-gossip",
+                        "--without-mingle",
+                    ],
+                    env=env,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+            )
+    return processes
+
+
+def _stop_workers(processes: List[subprocess.Popen]) -> None:
+    """Warm shutdown of the workers, killed if they take too long"""
+    for p in processes:
+        p.terminate()
+    for p in processes:
+        try:
+            p.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+
+def _task_seconds(directory: Path) -> Dict[str, List[Tuple[float, float]]]:
+    """
+    Reads the `ielove_task_seconds` histogram of all worker processes, and
+    returns its cumulative (upper bound, count) buckets by task name
+    """
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=str(directory))
+    buckets: Dict[str, List[Tuple[float, float]]] = defaultdict(list)
+    for metric in registry.collect():
+        if metric.name != "ielove_task_seconds":
+            continue
+        for s in metric.samples:
+            if s.name.endswith("_bucket"):
+                buckets[s.labels["task"]].append(
+                    (float(s.labels["le"]), s.value)
+                )
+    return buckets
+
+
+def _wait_for_workers(app: Celery, n: int, timeout: float = 60) -> None:
+    """Waits until `n` workers answer pings"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if len(app.control.ping(timeout=1.0)) >= n:
+            return
+    raise RuntimeError(f"{n} workers did not start within {timeout} seconds")
+
+
+def histogram_quantile(
+    buckets: List[Tuple[float, float]], q: float
+) -> Optional[float]:
+    """
+    Estimates a quantile from the cumulative (upper bound, count) buckets of a
+    Prometheus histogram, by linear interpolation within buckets
+    """
+    buckets = sorted(buckets)
+    if not buckets or buckets[-1][1] == 0:
+        return None
+    rank, lower, below = q * buckets[-1][1], 0.0, 0.0
+    for bound, count in buckets:
+        if count >= rank:
+            if isinf(bound):
+                return lower
+            return lower + (bound - lower) * (rank - below) / (
+                (count - below) or 1
+            )
+        lower, below = bound, count
+    return None  # Unreachable
+
+
+@contextmanager
+def _databases(redis_db: int, mongo_db: str) -> Iterator[None]:
+    """
+    Points this process, and the workers it starts, to the load test
+    databases. Raises a `ValueError` if they are the main ones (as set by the
+    `REDIS_DB` and `MONGO_DB` environment variables), since runs empty them.
+    """
+    if mongo_db == os.environ.get("MONGO_DB", "ielove"):
+        raise ValueError(f"'{mongo_db}' is the main MongoDB database")
+    if redis_db == int(os.environ.get("REDIS_DB", "0")):
+        raise ValueError(f"{redis_db} is the Redis database used as broker")
+    previous = {k: os.environ.get(k) for k in ["MONGO_DB", "REDIS_DB"]}
+    os.environ.update(MONGO_DB=mongo_db, REDIS_DB=str(redis_db))
+    get_redis.cache_clear()
+    try:
+        yield
+    finally:
+        for k, v in previous.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        get_redis.cache_clear()
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+# pylint: disable=too-many-locals
+def run(
+    site: FakeSite,
+    setting: Setting,
+    partitions: List[Tuple[str, str]],
+    task: str = "scrape_region",
+    timeout: float = 600,
+    env: Optional[Dict[str, str]] = None,
+    *,
+    redis_db: int = 15,
+    mongo_db: str = "ielove_loadtest",
+) -> Dict[str, Any]:
+    """
+    Empties the load test databases (see `_databases`), starts workers,
+    submits one `task` per (property type, region) partition, and waits until
+    the pipeline is idle (nothing queued nor reserved, and no request nor
+    commit for 3 seconds) or until `timeout` seconds have passed. Returns the measurements of the run
+    (see module documentation), including the time series under `series`.
+
+    Args:
+        site (FakeSite): Must be started
+        setting (Setting):
+        partitions (List[Tuple[str, str]]): (Property type, region) pairs
+        task (str): Either `scrape_region` or `discover_region`
+        timeout (float): In seconds
+        env (Optional[Dict[str, str]]): Environment of the workers
+        redis_db (int): Redis database used as broker, emptied
+        mongo_db (str): MongoDB database, emptied
+    """
+    with _databases(redis_db, mongo_db):
+        redis = Redis.from_url(get_redis_uri())
+        redis.flushdb()
+        db.get_client().drop_database(db.get_database().name)
+        db.ensure_indices()
+        site.counters.clear()
+        directory = Path(tempfile.mkdtemp(prefix="ielove-loadtest-"))
+        env = {
+            **(env or {}),
+            "IELOVE_BASE_URL": site.url,
+            "IELOVE_CACHE_MODE": "off",
+            "IELOVE_THROTTLE_INTERVAL": str(setting.min_interval),
+            "IELOVE_THROTTLE_MIN_INTERVAL": str(setting.min_interval),
+            "PROMETHEUS_MULTIPROC_DIR": str(directory),
+            "MONGO_DB": mongo_db,
+            "REDIS_DB": str(redis_db),
+        }
+        logging.info("Load test run {} (logs in {})", setting, directory)
+        app, processes = get_app(), _start_workers(setting, env, directory)
+        try:
+            _wait_for_workers(app, setting.workers)
+            db_ops, redis_ops = _db_ops(), _redis_commands(redis)
+            start, idle = time.monotonic(), 0
+            for property_type, region in partitions:
+                app.send_task(
+                    f"ielove.tasks.{task}",
+                    (region, property_type),
+                    queue=frontier.queue("discovery", property_type, region),
+                )
+            series = [_sample(redis, site, start)]
+            while time.monotonic() - start < timeout and idle < 3:
+                time.sleep(1)
+                series.append(_sample(redis, site, start))
+                previous = series[-2]
+                busy = (
+                    series[-1]["queued"] > 0
+                    or series[-1]["unacked"] > 0
+                    or previous["requests"] != series[-1]["requests"]
+                    or previous["properties"] != series[-1]["properties"]
+                )
+                idle = 0 if busy else idle + 1
+            # Time of the last change. Samples are 1 second apart, except the
+            # first one, taken right after the submission
+            elapsed = max(series[-1 - idle]["t"], 1.0)
+            db_ops = _db_ops() - db_ops
+            redis_ops = _redis_commands(redis) - redis_ops
+        finally:
+            _stop_workers(processes)
+        buckets = _task_seconds(directory).get(
+            "ielove.tasks.scrape_property_page", []
+        )
+        properties = series[-1]["properties"]
+        return {
+            **setting._asdict(),
+            "elapsed": elapsed,
+            "properties": properties,
+            "throughput": properties / elapsed,
+            "requests": site.counters["requests"],
+            "errors": site.counters["errors"],
+            "p50": histogram_quantile(buckets, 0.5),
+            "p99": histogram_quantile(buckets, 0.99),
+            "max_queued": max(s["queued"] for s in series),
+            "mean_queued": sum(s["queued"] for s in series) / len(series),
+            "db_ops_per_s": db_ops / elapsed,
+            "redis_ops_per_s": redis_ops / elapsed,
+            "timed_out": idle < 3,
+            "series": series,
+        }
+
+
+# pylint: disable=too-many-arguments,too-many-positional-arguments
+def sweep(
+    site: FakeSite,
+    settings: Iterable[Setting],
+    partitions: List[Tuple[str, str]],
+    task: str = "scrape_region",
+    timeout: float = 600,
+    db_latency: float = 0.0,
+    *,
+    redis_db: int = 15,
+    mongo_db: str = "ielove_loadtest",
+) -> Iterator[Dict[str, Any]]:
+    """
+    Runs (see `run`) every setting in turn on the given databases, and yields
+    the results as they come. If `db_latency` is positive, the workers reach
+    Redis and MongoDB through `LatencyProxy`s adding that many seconds of
+    round-trip time.
+    """
+    env, proxies = dict(os.environ), []
+    for k in ["IELOVE_NODE", "METRICS_PORT"]:
+        env.pop(k, None)
+    if db_latency > 0:
+        for prefix, port in [("REDIS", "6379"), ("MONGO", "27017")]:
+            proxy = LatencyProxy(
+                env.get(f"{prefix}_HOST", "localhost"),
+                int(env.get(f"{prefix}_PORT", port)),
+                db_latency,
+            )
+            env[f"{prefix}_HOST"] = "127.0.0.1"
+            env[f"{prefix}_PORT"] = str(proxy.start())
+            proxies.append(proxy)
+    try:
+        for setting in settings:
+            yield run(
+                site,
+                setting,
+                partitions,
+                task,
+                timeout,
+                env,
+                redis_db=redis_db,
+                mongo_db=mongo_db,
+            )
+    finally:
+        for proxy in proxies:
+            proxy.stop()
@@ -0,0 +1,201 @@
+"""
+Instrumentation: per-stage Prometheus metrics and an opt-in profiler.
+
+Metrics are exposed over HTTP by `start_metrics_server` (Celery workers, see
+`ielove.celery`) or mounted on the web UI (see `ielove.webui`). If the workers
+use a prefork pool, set the `PROMETHEUS_MULTIPROC_DIR` environment variable to
+an empty, writable directory so that the metrics of all child processes are
+aggregated.
+
+The profiler is enabled by setting `IELOVE_PROFILE_TOP_N` to a positive
+integer (or by passing `--profile` to the CLI). Only the reports of the
+slowest N profiled runs (per process) are kept in `IELOVE_PROFILE_DIR`
+(default: `profiles/`). Reports are `cProfile` dumps, which can be inspected
+with e.g. `python -m pstats` or `snakeviz`.
+"""
+
+import cProfile
+import heapq
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+from typing import Iterator, List, Optional, Tuple
+
+from loguru import logger as logging
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+
+STAGE_SECONDS = Histogram(
+    "ielove_stage_seconds",
+    "Time spent in each scraping stage",
+    ["stage"],
+)
+"""
+Stages are `fetch` (HTTP round-trip), `parse` (HTML parsing), `normalize`
+(extraction and string processing), `floor_plan` (floor plan image download),
+and `db` (database reads and writes)
+"""
+
+FETCH_BYTES = Counter(
+    "ielove_fetch_bytes",
+    "Number of bytes downloaded",
+    ["method"],
+)
+
+FETCH_ERRORS = Counter(
+    "ielove_fetch_errors",
+    "Number of failed HTTP requests",
+    ["method"],
+)
+
+CACHE_HITS = Counter(
+    "ielove_cache_hits",
+    "Number of lookups that avoided a fetch",
+    ["cache"],
+)
+
+EXTRACTED_FIELDS = Counter(
+    "ielove_extracted_fields",
+    "Number of fields found (hit) or not (miss) in scraped pages",
+    ["page", "field", "result"],
+)
+
+ARCHIVED_PROPERTIES = Counter(
+    "ielove_archived_properties",
+    "Number of properties moved to the archive (see ielove.archive)",
+    ["reason"],
+)
+
+DUPLICATES_SUPPRESSED = Counter(
+    "ielove_duplicates_suppressed",
+    "Number of tasks not enqueued because the same page is already in flight",
+    ["kind"],
+)
+
+THROTTLE_INTERVAL = Gauge(
+    "ielove_throttle_interval_seconds",
+    "Interval between two requests to a host (see ielove.throttle)",
+    ["host"],
+    multiprocess_mode="mostrecent",
+)
+
+TASK_SECONDS = Histogram(
+    "ielove_task_seconds",
+    "Celery task run time",
+    ["task"],
+)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """
+    Context manager that records the time spent in its body under the given
+    stage (see `STAGE_SECONDS`).
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(perf_counter() - start)
+
+
+def start_metrics_server(port: Optional[int] = None) -> None:
+    """
+    Starts the Prometheus HTTP endpoint. If `port` is not provided, it is read
+    from the `METRICS_PORT` environment variable. If that is not set either,
+    nothing happens.
+    """
+    if port is None:
+        if "METRICS_PORT" not in os.environ:
+            return
+        port = int(os.environ["METRICS_PORT"])
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        start_http_server(port, registry=registry)
+    else:
+        start_http_server(port)
+    logging.info("Serving Prometheus metrics on port {}", port)
+
+
+class Profiler:
+    """
+    Profiles blocks of code with `cProfile`, and keeps only the reports of the
+    `top_n` slowest ones on disk.
+    """
+
+    directory: Path
+    top_n: int
+    _reports: List[Tuple[float, str]]  # min-heap of (duration, path)
+
+    def __init__(self, top_n: int, directory: str = "profiles") -> None:
+        self.directory = Path(directory)
+        self.top_n = top_n
+        self._reports = []
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[None]:
+        """Profiles the body of the context manager"""
+        profiler = cProfile.Profile()
+        start = perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._keep(profiler, name, perf_counter() - start)
+
+    def _keep(self, profiler: cProfile.Profile, name: str, t: float) -> None:
+        """Saves the report if it is one of the `top_n` slowest"""
+        if len(self._reports) >= self.top_n and t <= self._reports[0][0]:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r"[^\w\-.]+", "_", name)
+        path = str(self.directory / f"{name}.{os.getpid()}.{t:.3f}s.prof")
+        profiler.dump_stats(path)
+        logging.debug("Saved profile report '{}' ({:.3f}s)", path, t)
+        if len(self._reports) >= self.top_n:
+            _, evicted = heapq.heapreplace(self._reports, (t, path))
+            Path(evicted).unlink(missing_ok=True)
+        else:
+            heapq.heappush(self._reports, (t, path))
+
+
+_profiler: Optional[Profiler] = None
+
+
+def get_profiler() -> Optional[Profiler]:
+    """
+    Returns the process-wide profiler, or `None` if profiling is disabled (see
+    module documentation).
+    """
+    global _profiler  # pylint: disable=global-statement
+    if _profiler is None:
+        top_n = int(os.environ.get("IELOVE_PROFILE_TOP_N", "0"))
+        if top_n > 0:
+            _profiler = Profiler(
+                top_n, os.environ.get("IELOVE_PROFILE_DIR", "profiles")
+            )
+    return _profiler
+
+
+@contextmanager
+def profiled(name: str) -> Iterator[None]:
+    """
+    Profiles the body of the context manager if profiling is enabled, does
+    nothing otherwise.
+    """
+    profiler = get_profiler()
+    if profiler is None:
+        yield
+    else:
+        with profiler.profile(name):
+            yield
@@ -0,0 +1,199 @@
+"""
+Market statistics, maintained incrementally. The `stats` collection holds one
+document per (property type, prefecture, city, ward), with the number of
+properties, and the sums of prices (賃料 for rentals, 価格 otherwise), areas,
+and prices per m². Each time a property is committed, the statistics of its
+previous version are decremented and those of its new version are
+incremented (see `update`), so reading statistics never requires scanning the
+`properties` collection.
+
+Quantiles of the price per m² are estimated from a histogram with
+`BUCKETS_PER_DOUBLING` logarithmic buckets per doubling, i.e. with a relative
+error of about 4%. Unlike t-digests, such histograms support removals, which
+are needed when a property is updated.
+"""
+
+import math
+from typing import Any, Dict, List, Optional
+
+import regex as re
+from pymongo import UpdateOne
+
+from ielove.db import INDICES, get_collection
+
+BUCKETS_PER_DOUBLING = 8
+
+GROUP_KEYS = ["type", "prefecture", "city", "ward"]
+
+
+def _bucket(x: float) -> int:
+    """Histogram bucket of a value"""
+    return max(0, math.floor(math.log2(max(x, 1)) * BUCKETS_PER_DOUBLING))
+
+
+def _increments(data: dict, sign: int) -> Dict[str, float]:
+    """`$inc` operand that adds (or removes if `sign` is -1) a property"""
+    values = property_values(data)
+    inc: Dict[str, float] = {"count": sign}
+    for k, v in values.items():
+        if v is not None:
+            inc[f"count_{k}"] = sign
+            inc[f"sum_{k}"] = sign * v
+    if (v := values["price_per_m2"]) is not None:
+        inc[f"hist.{_bucket(v)}"] = sign
+    return inc
+
+
+def group(data: dict) -> Dict[str, str]:
+    """The (type, prefecture, city, ward) group of a property document"""
+    location = data.get("location", {})
+    return {
+        "type": data["type"],
+        "prefecture": location.get("prefecture", "-"),
+        "city": location.get("city", "-"),
+        "ward": location.get("ward", "-"),
+    }
+
+
+def parse_area(x: Any) -> Optional[float]:
+    """Parses an area in m², e.g. `25.5m2`"""
+    if isinstance(x, (int, float)):
+        return float(x)
+    r = r"([\d,]+(?:\.\d+)?)\s*m2"
+    if isinstance(x, str) and (m := re.search(r, x)):
+        return float(m.group(1).replace(",", ""))
+    return None
+
+
+def parse_yen(x: Any) -> Optional[float]:
+    """Parses an amount in yen, e.g. `12.5万円` or `1億2,000万円`"""
+    if isinstance(x, (int, float)):
+        return float(x)
+    if not isinstance(x, str):
+        return None
+    n = r"([\d,]+(?:\.\d+)?)"
+    m = re.search(rf"(?:{n}億)?\s*(?:{n}万)?\s*{n}?\s*円", x)
+    if m is None or not any(m.groups()):
+        return None
+    f = lambda s: float(s.replace(",", "")) if s else 0.0
+    return f(m.group(1)) * 1e8 + f(m.group(2)) * 1e4 + f(m.group(3))
+
+
+def property_values(data: dict) -> Dict[str, Optional[float]]:
+    """
+    Numerical values of a property document that are aggregated: `price`,
+    `area`, and `price_per_m2`. Missing or unparseable values are `None`.
+    """
+    details = data.get("details", {})
+    price = parse_yen(
+        details.get("賃料" if data["type"] == "chintai" else "価格")
+    )
+    area = None
+    for k in ["専有面積", "建物面積", "土地面積"]:
+        if (area := parse_area(details.get(k))) is not None:
+            break
+    return {
+        "price": price,
+        "area": area,
+        "price_per_m2": price / area if price and area else None,
+    }
+
+
+def quantile(hist: Dict[str, int], q: float) -> Optional[float]:
+    """Estimates a quantile from a histogram (see module documentation)"""
+    buckets = sorted((int(k), v) for k, v in hist.items() if v > 0)
+    total = sum(v for _, v in buckets)
+    if total == 0:
+        return None
+    seen = 0
+    for k, v in buckets:
+        seen += v
+        if seen >= q * total:
+            return 2 ** ((k + 0.5) / BUCKETS_PER_DOUBLING)
+    return None  # Unreachable
+
+
+def rebuild() -> int:
+    """
+    Recomputes all statistics from the `properties` collection. Returns the
+    number of groups. Updates made by workers during the rebuild are lost, so
+    preferably run this while they are idle.
+    """
+    groups: Dict[tuple, Dict[str, float]] = {}
+    fields = ["賃料", "価格", "専有面積", "建物面積", "土地面積"]
+    projection = {"type": 1, "location": 1}
+    projection.update({f"details.{k}": 1 for k in fields})
+    for data in get_collection("properties").find({}, projection=projection):
+        g = tuple(group(data).values())
+        acc = groups.setdefault(g, {})
+        for k, v in _increments(data, 1).items():
+            acc[k] = acc.get(k, 0) + v
+    documents = []
+    for g, acc in groups.items():
+        document: Dict[str, Any] = dict(zip(GROUP_KEYS, g))
+        document["hist"] = {}
+        for k, v in acc.items():
+            if k.startswith("hist."):
+                document["hist"][k[5:]] = v
+            else:
+                document[k] = v
+        documents.append(document)
+    # Built aside and then swapped in, so that readers never see partial stats
+    collection = get_collection("stats_rebuild")
+    collection.drop()
+    collection.create_indexes(INDICES["stats"])
+    if documents:
+        collection.insert_many(documents)
+    collection.rename("stats", dropTarget=True)
+    return len(documents)
+
+
+def summarize(document: dict) -> Dict[str, Any]:
+    """
+    Derived statistics of a `stats` document: number of properties, means of
+    price, area, and price per m², and quartiles of price per m²
+    """
+    result: Dict[str, Any] = {k: document[k] for k in GROUP_KEYS}
+    result["count"] = document.get("count", 0)
+    for k in ["price", "area", "price_per_m2"]:
+        n = document.get(f"count_{k}", 0)
+        result[f"mean_{k}"] = document[f"sum_{k}"] / n if n > 0 else None
+    hist = document.get("hist", {})
+    for q, name in [(0.25, "q1"), (0.5, "median"), (0.75, "q3")]:
+        result[f"{name}_price_per_m2"] = quantile(hist, q)
+    return result
+
+
+def get_stats(
+    property_type: Optional[str] = None, prefecture: Optional[str] = None
+) -> List[Dict[str, Any]]:
+    """
+    Returns the summarized statistics (see `summarize`) of all groups,
+    optionally filtered by property type and prefecture (e.g. `東京都`)
+    """
+    query = {}
+    if property_type is not None:
+        query["type"] = property_type
+    if prefecture is not None:
+        query["prefecture"] = prefecture
+    documents = get_collection("stats").find(
+        query, sort=[(k, 1) for k in GROUP_KEYS]
+    )
+    return [summarize(d) for d in documents if d.get("count", 0) > 0]
+
+
+def update(old: Optional[dict], new: Optional[dict]) -> None:
+    """
+    Updates the statistics after a property document has been replaced. Either
+    may be `None`, e.g. if the property is new.
+    """
+    operations = []
+    for data, sign in [(old, -1), (new, 1)]:
+        if data is not None:
+            operations.append(
+                UpdateOne(
+                    group(data), {"$inc": _increments(data, sign)}, upsert=True
+                )
+            )
+    if operations:
+        get_collection("stats").bulk_write(operations, ordered=False)
@@ -1,14 +1,37 @@
 # pylint: disable=missing-function-docstring
 """Celery tasks"""
 
+import random
+import uuid
 from datetime import datetime, timedelta
-from typing import Optional
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set
 
+import requests
+from celery import Task, group
+from celery.exceptions import Retry
 from loguru import logger as logging
 
-from ielove import db, ielove
+from ielove import archive, db, frontier, ielove, leases, stats
 from ielove.celery import app
-from ielove.utils import url_or_pid_to_pid
+from ielove.metrics import CACHE_HITS, timed
+from ielove.utils import retry_after, url_or_pid_to_pid
+
+MAX_RETRIES = 5
+"""
+Maximum number of retries of a task that failed because of a transient HTTP
+error, see `_should_retry`
+"""
+
+_page_counts: frontier.LocalCache[int] = frontier.LocalCache(ttl=6 * 3600)
+"""
+Number of result pages by (property type, region), see `scrape_region`. Since
+a partition is always handled by the same node (see `ielove.frontier`), this
+spares most calls to `ielove.ielove.last_result_page_idx`.
+"""
+
+_fresh_pids: frontier.LocalCache[bool] = frontier.LocalCache(ttl=3600)
+"""Pids known to have been scraped recently, see `_property_pids_to_skip`"""
 
 
 def _next_property_page_scrape_datetime(data: dict) -> datetime:
@@ -27,17 +50,82 @@ def _next_result_page_scrape_datetime(data: dict) -> datetime:
     return data["datetime"] + timedelta(days=30)
 
 
+def _retry(task: Task, e: requests.exceptions.RequestException) -> Retry:
+    """
+    Retries a task with exponential backoff (about 1, 2, 4... minutes), or
+    after the delay requested by the server if longer. Raises
+    `celery.exceptions.Retry`.
+    """
+    countdown = 60 * 2**task.request.retries * random.uniform(0.5, 1.5)
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        countdown = max(countdown, retry_after(e.response) or 0)
+    logging.warning(
+        "Task {}{} failed ({} {}), retrying in {:.0f}s",
+        task.name,
+        task.request.args,
+        type(e),
+        str(e),
+        countdown,
+    )
+    return task.retry(exc=e, countdown=countdown)
+
+
+def _should_retry(task: Task, e: requests.exceptions.RequestException) -> bool:
+    """
+    Returns `True` if a task that raised `e` should be retried, i.e. if the
+    error is transient (network error, timeout, 429, or 5xx), if the task has
+    retries left, and if it runs in a worker.
+    """
+    if task.request.called_directly or task.request.retries >= MAX_RETRIES:
+        return False
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        status = e.response.status_code
+        return status in [408, 429] or status >= 500
+    return True
+
+
 def _should_scrape_property_page(url: str) -> bool:
     """
-    Returns `True` if the property has never been scraped, or if the current
-    datatime is after that provided by `_next_scrape_datetime`.
+    Returns `True` if the property has never been scraped and has not been
+    archived (see `ielove.archive`), or if the current datatime is after that
+    provided by `_next_scrape_datetime`.
     """
     pid = url_or_pid_to_pid(url)
     collection = db.get_collection("properties")
-    data: Optional[dict] = collection.find_one({"pid": pid})
-    return data is None or (
-        datetime.now() >= _next_property_page_scrape_datetime(data)
-    )
+    with timed("db"):
+        data: Optional[dict] = collection.find_one({"pid": pid})
+        if data is None:
+            return not archive.tombstoned([pid])
+    return datetime.now() >= _next_property_page_scrape_datetime(data)
+
+
+def _property_pids_to_skip(pids: Iterable[str]) -> Set[str]:
+    """
+    Returns the pids among `pids` that should not be scraped (see
+    `_should_scrape_property_page`), in at most two database queries. Pids
+    found fresh are remembered for a while (see `_fresh_pids`).
+    """
+    pids = list(pids)
+    fresh = {p for p in pids if _fresh_pids.get(p)}
+    pids = [p for p in pids if p not in fresh]
+    if not pids:
+        return fresh
+    collection = db.get_collection("properties")
+    with timed("db"):
+        documents = list(
+            collection.find(
+                {"pid": {"$in": pids}},
+                projection={"pid": 1, "details.次回更新予定日": 1},
+            )
+        )
+        unknown = set(pids) - {d["pid"] for d in documents}
+        skip = archive.tombstoned(unknown) if unknown else set()
+    now = datetime.now()
+    for d in documents:
+        if now < _next_property_page_scrape_datetime(d):
+            _fresh_pids.set(d["pid"], True)
+            fresh.add(d["pid"])
+    return skip | fresh
 
 
 def _should_scrape_result_page(url: str) -> bool:
@@ -48,36 +136,209 @@ def _should_scrape_result_page(url: str) -> bool:
     meta = ielove.result_page_metadata(url)
     del meta["url"]
     collection = db.get_collection("results")
-    data: Optional[dict] = collection.find_one(meta)
+    with timed("db"):
+        data: Optional[dict] = collection.find_one(meta)
     return data is None or (
         datetime.now() >= _next_result_page_scrape_datetime(data)
     )
 
 
-@app.task(rate_limit="20/m")
-def scrape_property_page(url: str) -> None:
+def _result_page_count(
+    task: Task, property_type: str, region: str, default: int
+) -> int:
+    """
+    Number of result pages of a (property type, region) pair, see
+    `ielove.ielove.last_result_page_idx` and `_page_counts`. If it cannot be
+    determined because of a transient HTTP error, the task is retried. If it
+    still cannot be determined, returns `default`.
+    """
+    url = f"{ielove.BASE_URL}/{property_type}/{region}/result/"
+    try:
+        if (n := _page_counts.get((property_type, region))) is None:
+            n = ielove.last_result_page_idx(url)
+            _page_counts.set((property_type, region), n)
+        else:
+            CACHE_HITS.labels("page_count").inc()
+        logging.info(
+            "Results for property type '{}' in region '{}': found {} pages",
+            property_type,
+            region,
+            n,
+        )
+        return n
+    except Exception as e:
+        if isinstance(
+            e, requests.exceptions.RequestException
+        ) and _should_retry(task, e):
+            raise _retry(task, e) from e
+        logging.warning(
+            "Could not determine last result page index for property type "
+            "'{}' in region '{}': {} {}",
+            property_type,
+            region,
+            type(e),
+            str(e),
+        )
+    return default
+
+
+def _run_on_owner(
+    task: Task, property_type: str, region: str, args: tuple
+) -> bool:
+    """
+    Sends a task of a (property type, region) partition again, to the
+    `discovery` queue of the node owning the partition (see
+    `ielove.frontier`), unless it already runs there. This way, the caches
+    filled by the task (e.g. `_page_counts`) are those of that node. Returns
+    `True` if the task has been sent again, in which case it should stop
+    right away. Tasks that are called directly (e.g. by the CLI) are never
+    sent again.
+    """
+    if task.request.called_directly:
+        return False
+    owner = frontier.node_for(property_type, region)
+    if owner is None or owner == frontier.get_node():
+        return False
+    priority = (task.request.delivery_info or {}).get("priority")
+    task.apply_async(args, queue=f"discovery.{owner}", priority=priority)
+    logging.debug(
+        "Sent {} of '{}' in region '{}' to node '{}'",
+        task.name,
+        property_type,
+        region,
+        owner,
+    )
+    return True
+
+
+def _stream_result_pages(
+    url: str,
+    limit: int,
+    errors: List[requests.exceptions.RequestException],
+) -> Iterator[str]:
+    """
+    Yields the property page URLs of result pages 1 to `limit` of `url`, see
+    `ielove.ielove.stream_result_page`. Result pages that have been scraped
+    too recently or that are in flight are skipped. Each result page is
+    committed once all of its properties have been yielded. If a page cannot
+    be fetched, the error is appended to `errors` and the iteration stops.
+    """
+    for i in range(1, limit + 1):
+        a = f"{url}?pg={i}"
+        meta = ielove.result_page_metadata(a)
+        key = leases.result_page_key(meta)
+        if not _should_scrape_result_page(a):
+            logging.debug("Skipped streaming of result page '{}'", a)
+            CACHE_HITS.labels("result_page").inc()
+            continue
+        token = str(uuid.uuid4())
+        if not leases.acquire(key, token):
+            logging.debug("Result page '{}' is already in flight", a)
+            continue
+        data = {"datetime": datetime.now(), **meta, "properties": []}
+        try:
+            for page in ielove.stream_result_page(a):
+                data["properties"].append(page)
+                yield page["url"]
+            collection = db.get_collection("results")
+            with timed("db"):
+                collection.find_one_and_replace(
+                    {k: data[k] for k in ["type", "region", "idx"]},
+                    data,
+                    upsert=True,
+                )
+        except requests.exceptions.RequestException as e:
+            errors.append(e)
+            return
+        finally:
+            leases.release(key, token)
+        archive.mark_seen([page["pid"] for page in data["properties"]])
+
+
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def scrape_floor_plan(self: Task, url: str) -> None:
+    """
+    Downloads a floor plan image and commits its thumbnail to the
+    `floor_plans` collection (see `ielove.ielove.scrape_floor_plan`).
+    Transient HTTP errors are retried with exponential backoff.
+    """
+    key = leases.floor_plan_key(url)
+    try:
+        data = ielove.scrape_floor_plan(url)
+        collection = db.get_collection("floor_plans")
+        with timed("db"):
+            collection.find_one_and_replace({"url": url}, data, upsert=True)
+    except requests.exceptions.RequestException as e:
+        if _should_retry(self, e):
+            raise _retry(self, e) from e  # The lease is kept
+        logging.error(
+            "Could not get floor plan '{}': {} {}", url, type(e), str(e)
+        )
+    except Exception as e:
+        logging.error(
+            "Could not process and commit floor plan '{}': {} {}",
+            url,
+            type(e),
+            str(e),
+        )
+    leases.release(key, self.request.id)
+
+
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def scrape_property_page(self: Task, url: str) -> None:
     """
     Scrapes a property page if `_should_scrape_property_page` returns `True`.
-    If so, the data is committed to the database, and task is scheduled to
-    rescrape this page later (see `_next_property_page_scrape_datetime`)
+    If so, the data is committed to the database, market statistics are
+    updated (see `ielove.stats`), the floor plan image is scheduled for
+    download (see `submit_floor_plan`), and task is scheduled to
+    rescrape this page later (see `_next_property_page_scrape_datetime`).
+    Transient HTTP errors are retried with exponential backoff. If the page
+    is gone (404 or 410), the property is archived (see `ielove.archive`).
     """
+    key = leases.property_page_key(url_or_pid_to_pid(url))
     if not _should_scrape_property_page(url):
         logging.debug(
             "Property page '{}' has been scraped too recently, skipping", url
         )
+        CACHE_HITS.labels("property_page").inc()
+        leases.release(key, self.request.id)
         return
     try:
         data = ielove.scrape_property_page(url)
+        data["last_seen"] = data["datetime"]
         collection = db.get_collection("properties")
-        collection.find_one_and_replace(
-            {"pid": data["pid"]}, data, upsert=True
-        )
+        with timed("db"):
+            old = collection.find_one_and_replace(
+                {"pid": data["pid"]}, data, upsert=True
+            )
+            stats.update(old, data)
+        _fresh_pids.set(data["pid"], True)
+        if "floor_plan" in data:
+            submit_floor_plan(data["floor_plan"]["url"])
+    except requests.exceptions.RequestException as e:
+        if _should_retry(self, e):
+            raise _retry(self, e) from e  # The lease is kept
+        if (
+            isinstance(e, requests.HTTPError)
+            and e.response is not None
+            and e.response.status_code in [404, 410]
+        ):
+            archive.archive([url_or_pid_to_pid(url)], "gone")
+        else:
+            logging.error(
+                "Could not scrape property page '{}': {} {}",
+                url,
+                type(e),
+                str(e),
+            )
     except Exception as e:
         logging.error(
-            "Could not scrape and commit property page '{url}': {} {}",
+            "Could not scrape and commit property page '{}': {} {}",
+            url,
             type(e),
             str(e),
         )
+    leases.release(key, self.request.id)
     # eta = _next_property_page_scrape_datetime(data)
     # scrape_property_page.apply_async((url,), eta=eta)
     # logging.debug(
@@ -85,33 +346,49 @@ def scrape_property_page(url: str) -> None:
     # )
 
 
-@app.task(rate_limit="20/m")
-def scrape_result_page(url: str) -> None:
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def scrape_result_page(self: Task, url: str) -> None:
     """
     Scrapes a result page if `_should_scrape_result_page` returns `True`. If
-    so, the data is committed to the database, tasks are scheduled to scrape
-    the property pages found in this result page (see `scrape_property_page`),
-    except for the ones that have been scraped too recently (see
-    `_should_scrape_property_page`). Furthermore, an additional task is
-    scheduled to rescrape this result page later (see
-    `_next_result_page_scrape_datetime`).
+    so, the data is committed to the database, the properties found in this
+    result page are marked as seen (see `ielove.archive.mark_seen`), and
+    tasks are scheduled to scrape their pages (see `submit_property_pages`),
+    except for the ones that have been scraped too recently. Furthermore, an
+    additional task is scheduled to rescrape this result page later (see
+    `_next_result_page_scrape_datetime`). Transient HTTP errors are retried
+    with exponential backoff.
     """
+    key = leases.result_page_key(ielove.result_page_metadata(url))
     if not _should_scrape_result_page(url):
         logging.debug(
             "Result page '{}' has been scraped too recently, skipping", url
         )
+        CACHE_HITS.labels("result_page").inc()
+        leases.release(key, self.request.id)
         return
-    data = ielove.scrape_result_page(url)
-    collection = db.get_collection("results")
-    collection.find_one_and_replace(
-        {k: data[k] for k in ["type", "region", "idx"]}, data, upsert=True
+    retrying = False
+    try:
+        data = ielove.scrape_result_page(url)
+        collection = db.get_collection("results")
+        with timed("db"):
+            collection.find_one_and_replace(
+                {k: data[k] for k in ["type", "region", "idx"]},
+                data,
+                upsert=True,
+            )
+    except requests.exceptions.RequestException as e:
+        if _should_retry(self, e):
+            retrying = True  # The lease is kept
+            raise _retry(self, e) from e
+        raise
+    finally:
+        if not retrying:
+            leases.release(key, self.request.id)
+    archive.mark_seen([page["pid"] for page in data["properties"]])
+    submit_property_pages(
+        (page["url"] for page in data["properties"]),
+        queue=frontier.queue("bulk", data["type"], data["region"]),
     )
-    for page in data["properties"]:
-        url = page["url"]
-        if _should_scrape_property_page(url):
-            scrape_property_page.delay(url)
-        else:
-            logging.debug("Skipped scraping of property page '{}'", url)
     # eta = _next_result_page_scrape_datetime(data)
     # scrape_result_page.apply_async((url,), eta=eta)
     # logging.debug(
@@ -119,35 +396,170 @@ def scrape_result_page(url: str) -> None:
     # )
 
 
-@app.task(rate_limit="20/m")
-def scrape_region(region: str, property_type: str, limit: int = 100) -> None:
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def discover_region(
+    self: Task, region: str, property_type: str, limit: int = 100
+) -> int:
     """
-    Scrapes all properties of a given type in a given region. Result pages for
-    this type/region tuple are enumerated, and those for which
-    `_should_scrape_result_page` returns `True` are scheduled for scraping (see
-    `scrape_result_page`).
+    Lightweight alternative to `scrape_region`: the result pages are streamed
+    one after the other by this task (see `_stream_result_pages`), and the
+    properties are scheduled (see `submit_property_pages`) as they are found,
+    without a task nor a full HTML parse per result page. If a result page
+    cannot be fetched because of a transient HTTP error, the properties found
+    so far are still scheduled, and the task is retried with exponential
+    backoff; committed result pages are then skipped. Returns the number of
+    scheduled property pages (0 if the task has been sent to the node owning
+    this partition instead, see `_run_on_owner`).
     """
-    url = f"https://www.ielove.co.jp/{property_type}/{region}/result/"
-    try:
-        limit = ielove.last_result_page_idx(url)
-        logging.info(
-            "Results for property type '{}' in region '{}': found {} pages",
+    if _run_on_owner(
+        self, property_type, region, (region, property_type, limit)
+    ):
+        return 0
+    url = f"{ielove.BASE_URL}/{property_type}/{region}/result/"
+    limit = _result_page_count(self, property_type, region, limit)
+    errors: List[requests.exceptions.RequestException] = []
+    n = submit_property_pages(
+        _stream_result_pages(url, limit, errors),
+        chunk_size=100,
+        queue=frontier.queue("bulk", property_type, region),
+    )
+    logging.info(
+        "Discovered {} property pages of type '{}' in region '{}'",
+        n,
+        property_type,
+        region,
+    )
+    if errors:
+        if _should_retry(self, errors[0]):
+            raise _retry(self, errors[0])
+        logging.error(
+            "Could not stream result pages of type '{}' in region '{}': "
+            "{} {}",
             property_type,
             region,
-            limit,
-        )
-    except Exception as e:
-        logging.warning(
-            "Could not determine last result page index for property type "
-            "'{}' in region '{}': {} {}",
-            property_type,
-            region,
-            type(e),
-            str(e),
+            type(errors[0]),
+            str(errors[0]),
         )
+    return n
+
+
+@app.task(bind=True, max_retries=MAX_RETRIES)
+def scrape_region(
+    self: Task, region: str, property_type: str, limit: int = 100
+) -> None:
+    """
+    Scrapes all properties of a given type in a given region. Result pages for
+    this type/region tuple are enumerated, and those for which
+    `_should_scrape_result_page` returns `True` are scheduled for scraping (see
+    `scrape_result_page`) on the node owning this partition (see
+    `ielove.frontier`), where this task runs too (see `_run_on_owner`). If
+    the number of result pages cannot be determined because of a transient
+    HTTP error, the task is retried with exponential backoff. If it still
+    cannot be determined, `limit` is used instead.
+    """
+    if _run_on_owner(
+        self, property_type, region, (region, property_type, limit)
+    ):
+        return
+    url = f"{ielove.BASE_URL}/{property_type}/{region}/result/"
+    queue = frontier.queue("discovery", property_type, region)
+    limit = _result_page_count(self, property_type, region, limit)
     for i in range(1, limit + 1):
-        a = f"{url}?pg={i}"
-        if _should_scrape_result_page(a):
-            scrape_result_page.delay(a)
-        else:
+        a, task_id = f"{url}?pg={i}", str(uuid.uuid4())
+        if not _should_scrape_result_page(a):
             logging.debug("Skipped scraping of result page '{}'", a)
+            CACHE_HITS.labels("result_page").inc()
+        elif leases.acquire(
+            leases.result_page_key(ielove.result_page_metadata(a)), task_id
+        ):
+            scrape_result_page.apply_async((a,), queue=queue, task_id=task_id)
+        else:
+            logging.debug("Result page '{}' is already in flight", a)
+
+
+@app.task
+def archive_delisted_properties() -> None:
+    """See `ielove.archive.archive_delisted`"""
+    archive.archive_delisted()
+
+
+def submit_floor_plan(url: str) -> None:
+    """
+    Schedules the download of a floor plan image (see `scrape_floor_plan`),
+    unless it has already been downloaded or is in flight. Floor plans are
+    identified by their URL, which is often shared by several listings of the
+    same building.
+    """
+    collection = db.get_collection("floor_plans")
+    with timed("db"):
+        known = collection.find_one({"url": url}, projection={"_id": 1})
+    task_id = str(uuid.uuid4())
+    if known is not None:
+        CACHE_HITS.labels("floor_plan").inc()
+    elif leases.acquire(leases.floor_plan_key(url), task_id):
+        scrape_floor_plan.apply_async((url,), task_id=task_id)
+
+
+def submit_property_pages(
+    urls: Iterable[str], chunk_size: int = 1000, queue: Optional[str] = None
+) -> int:
+    """
+    Schedules the scraping of many property pages at once (see
+    `scrape_property_page`). URLs are deduplicated by pid, and those that have
+    been scraped too recently, archived, or that are already in flight (see
+    `ielove.leases`) are skipped. Database lookups, lease acquisitions, and
+    task publication are done by chunks of `chunk_size` URLs. Returns the
+    number of tasks that have been scheduled.
+
+    Args:
+        urls (Iterable[str]): Property page URLs. Bare pids are not accepted
+            since the property type cannot be recovered from them.
+        chunk_size (int):
+        queue (Optional[str]): Queue to send the tasks to, e.g. that of a
+            frontier partition (see `ielove.frontier.queue`). Defaults to the
+            `bulk` queue.
+    """
+    options = {} if queue is None else {"queue": queue}
+    seen: Set[str] = set()
+    n_scheduled, it = 0, iter(urls)
+    while chunk := list(islice(it, chunk_size)):
+        batch: Dict[str, str] = {}  # pid -> url
+        for url in map(str.strip, chunk):
+            if not url.startswith("http"):
+                if url:
+                    logging.warning("Not a property page URL: '{}'", url)
+                continue
+            try:
+                pid = url_or_pid_to_pid(url)
+            except AttributeError:  # No last path segment
+                logging.warning("Not a property page URL: '{}'", url)
+                continue
+            if pid not in seen:
+                seen.add(pid)
+                batch[pid] = url
+        skip = _property_pids_to_skip(batch.keys())
+        CACHE_HITS.labels("property_page").inc(len(skip))
+        todo = [
+            (p, u, str(uuid.uuid4()))
+            for p, u in batch.items()
+            if p not in skip
+        ]
+        acquired = leases.acquire_many(
+            (leases.property_page_key(p), t) for p, _, t in todo
+        )
+        signatures = [
+            scrape_property_page.s(u).set(task_id=t)
+            for (_, u, t), a in zip(todo, acquired)
+            if a
+        ]
+        if signatures:
+            group(signatures).apply_async(**options)
+        logging.debug(
+            "Scheduled {} property pages, skipped {} fresh or archived and {} "
+            "in flight",
+            len(signatures),
+            len(skip),
+            len(acquired) - len(signatures),
+        )
+        n_scheduled += len(signatures)
+    return n_scheduled
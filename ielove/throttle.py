@@ -0,0 +1,117 @@
+"""
+Adaptive per-host request pacing. Requests to a given host are spaced by an
+interval that is shared by all processes through Redis, and that is tuned
+AIMD-style from the observed responses:
+- after a successful and fast response, the request rate is increased by
+  `IELOVE_THROTTLE_STEP` requests per minute (default: 1);
+- after an error (e.g. 429 or 503, or a network failure), or a response
+  slower than `IELOVE_THROTTLE_LATENCY` seconds (default: 2), the request rate
+  is halved.
+
+The interval starts at `IELOVE_THROTTLE_INTERVAL` seconds (default: 3, i.e.
+20 requests per minute), and stays between `IELOVE_THROTTLE_MIN_INTERVAL`
+(default: 0.5) and `IELOVE_THROTTLE_MAX_INTERVAL` (default: 120) seconds.
+Since requests are spaced, the number of concurrent requests to a host is
+bounded by the ratio of its latency to the interval.
+
+If the server sends a `Retry-After` header, no request is made to that host
+until then. If Redis is unreachable (e.g. when running the CLI without a
+broker), requests are not paced.
+"""
+
+import os
+from time import sleep, time
+from typing import Optional, cast
+
+from loguru import logger as logging
+from redis.exceptions import RedisError
+
+from ielove.celery import get_redis
+from ielove.metrics import THROTTLE_INTERVAL
+
+PREFIX = "ielove:throttle:"
+
+_RESERVE_SLOT = """
+local interval = tonumber(redis.call('HGET', KEYS[1], 'interval') or ARGV[2])
+local next = tonumber(redis.call('HGET', KEYS[1], 'next') or 0)
+local slot = math.max(tonumber(ARGV[1]), next)
+redis.call('HSET', KEYS[1], 'interval', interval, 'next', slot + interval)
+return tostring(slot)
+"""
+"""
+Reserves the next request slot of a host and returns its timestamp. Needs to
+be atomic since many processes may reserve slots concurrently.
+"""
+
+
+def _env(name: str, default: float) -> float:
+    """Reads a float setting from the environment"""
+    return float(os.environ.get(name, str(default)))
+
+
+def feedback(
+    host: str,
+    latency: float,
+    status: Optional[int],
+    retry_after: Optional[float] = None,
+) -> None:
+    """
+    Updates the request interval of a host after a request.
+
+    Args:
+        host (str):
+        latency (float): Response time, in seconds
+        status (Optional[int]): HTTP status code of the response, or `None` if
+            the request failed without response (e.g. timeout)
+        retry_after (Optional[float]): Value of the `Retry-After` header, in
+            seconds, if any
+    """
+    key = PREFIX + host
+    try:
+        r = get_redis()
+        interval = float(
+            cast(Optional[bytes], r.hget(key, "interval"))
+            or _env("IELOVE_THROTTLE_INTERVAL", 3)
+        )
+        rate = 1 / interval
+        if status is None or status in [408, 429] or status >= 500:
+            rate /= 2
+        elif latency > _env("IELOVE_THROTTLE_LATENCY", 2):
+            rate /= 2
+        else:
+            rate += _env("IELOVE_THROTTLE_STEP", 1) / 60
+        interval = min(
+            max(1 / rate, _env("IELOVE_THROTTLE_MIN_INTERVAL", 0.5)),
+            _env("IELOVE_THROTTLE_MAX_INTERVAL", 120),
+        )
+        # Not atomic: concurrent feedbacks may overwrite each other, which is
+        # fine for a controller
+        r.hset(key, "interval", str(interval))
+        if retry_after:
+            nxt = float(cast(Optional[bytes], r.hget(key, "next")) or 0)
+            r.hset(key, "next", str(max(nxt, time() + retry_after)))
+        THROTTLE_INTERVAL.labels(host).set(interval)
+    except RedisError as e:
+        logging.debug("Could not update throttle of '{}': {}", host, e)
+
+
+def wait(host: str) -> None:
+    """Blocks until the next request slot of a host"""
+    try:
+        slot = float(
+            cast(
+                bytes,
+                get_redis().eval(
+                    _RESERVE_SLOT,
+                    1,
+                    PREFIX + host,
+                    str(time()),
+                    str(_env("IELOVE_THROTTLE_INTERVAL", 3)),
+                ),
+            )
+        )
+    except RedisError as e:
+        logging.debug("Could not reserve slot for '{}': {}", host, e)
+        return
+    if (delay := slot - time()) > 0:
+        sleep(delay)
@@ -2,35 +2,186 @@
 General utilities
 """
 
+import codecs
 import datetime
-from typing import Any
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from time import perf_counter
+from typing import Any, Generator, Iterator, Optional
 from urllib.parse import urlparse
 
 import bs4
 import regex as re
 import requests
 from loguru import logger as logging
+from PIL import Image
+
+from ielove import cache, throttle
+from ielove.metrics import (
+    CACHE_HITS,
+    FETCH_BYTES,
+    FETCH_ERRORS,
+    STAGE_SECONDS,
+    timed,
+)
 
 
 def all_tag_contents(tag: bs4.element.Tag) -> list:
-    """Recursively extracts the content of every subtag"""
-    results = []
-    for c in tag.contents:
+    """
+    Recursively extracts the content of every subtag. See
+    `iter_tag_contents`.
+    """
+    return list(iter_tag_contents(tag))
+
+
+def iter_tag_contents(tag: bs4.element.Tag) -> Iterator[Any]:
+    """
+    Iterates over the strings of a tag and all its subtags, in document order,
+    processed by `process_string`
+    """
+    for c in tag.descendants:
         if isinstance(c, str):
-            results.append(process_string(c))
-        elif isinstance(c, bs4.element.Tag):
-            results += all_tag_contents(c)
-        else:
+            yield process_string(c)
+        elif not isinstance(c, bs4.element.Tag):
             logging.warning(f"Unsupported tag content '{type(c)}': {c}")
-    return results
+
+
+def fetch(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Issues an HTTP request, paced by `ielove.throttle`, or serves it from the
+    HTTP cache (see `ielove.cache`). Raises a `requests.HTTPError` if the
+    response has an error status code.
+
+    Args:
+        method (str): e.g. `get` or `post`
+        url (str):
+        kwargs: Passed to `requests.Request`, except `timeout` which defaults
+            to 20 seconds.
+    """
+    timeout = kwargs.pop("timeout", 20)
+    with requests.Session() as session:
+        # The session adds its default headers (User-Agent, Accept-Encoding...)
+        request = session.prepare_request(
+            requests.Request(method.upper(), url, **kwargs)
+        )
+        if (response := cache.load(request)) is not None:
+            logging.debug("{} {} (cached)", method.upper(), url)
+            CACHE_HITS.labels("http").inc()
+            response.raise_for_status()
+            return response
+        host = urlparse(url).netloc
+        throttle.wait(host)
+        logging.debug("{} {}", method.upper(), url)
+        start = perf_counter()
+        try:
+            settings = session.merge_environment_settings(
+                url, {}, None, None, None
+            )
+            response = session.send(request, timeout=timeout, **settings)
+        except requests.exceptions.RequestException:
+            FETCH_ERRORS.labels(method).inc()
+            throttle.feedback(host, perf_counter() - start, None)
+            raise
+    latency = perf_counter() - start
+    STAGE_SECONDS.labels("fetch").observe(latency)
+    FETCH_BYTES.labels(method).inc(len(response.content))
+    throttle.feedback(
+        host, latency, response.status_code, retry_after(response)
+    )
+    if not response.ok:
+        FETCH_ERRORS.labels(method).inc()
+    response.raise_for_status()
+    cache.store(request, response)
+    return response
+
+
+# pylint: disable=too-many-locals
+def fetch_stream(
+    method: str, url: str, chunk_size: int = 16384, **kwargs
+) -> Generator[str, None, None]:
+    """
+    Like `fetch`, but yields the decoded body of the response by chunks as it
+    is downloaded. If the caller stops iterating (and closes the generator),
+    the rest of the body is not downloaded. Bodies that are read completely
+    are stored in the HTTP cache, and cached responses are yielded in a single
+    chunk.
+
+    Args:
+        method (str): e.g. `get` or `post`
+        url (str):
+        chunk_size (int): In bytes
+        kwargs: See `fetch`
+    """
+    timeout = kwargs.pop("timeout", 20)
+    with requests.Session() as session:
+        request = session.prepare_request(
+            requests.Request(method.upper(), url, **kwargs)
+        )
+        if (response := cache.load(request)) is not None:
+            logging.debug("{} {} (cached)", method.upper(), url)
+            CACHE_HITS.labels("http").inc()
+            response.raise_for_status()
+            yield response.text
+            return
+        host = urlparse(url).netloc
+        throttle.wait(host)
+        logging.debug("{} {} (streamed)", method.upper(), url)
+        start = perf_counter()
+        try:
+            settings = session.merge_environment_settings(
+                url, {}, True, None, None
+            )
+            response = session.send(request, timeout=timeout, **settings)
+        except requests.exceptions.RequestException:
+            FETCH_ERRORS.labels(method).inc()
+            throttle.feedback(host, perf_counter() - start, None)
+            raise
+        with response:
+            # Time to first byte, the rest depends on the caller's pace
+            latency = perf_counter() - start
+            STAGE_SECONDS.labels("fetch").observe(latency)
+            throttle.feedback(
+                host, latency, response.status_code, retry_after(response)
+            )
+            if not response.ok:
+                FETCH_ERRORS.labels(method).inc()
+            response.raise_for_status()
+            keep = cache.get_mode() in ["record", "refresh-older-than"]
+            decoder = codecs.getincrementaldecoder(
+                response.encoding or "utf-8"
+            )(errors="replace")
+            content = []
+            for chunk in response.iter_content(chunk_size):
+                FETCH_BYTES.labels(method).inc(len(chunk))
+                if keep:
+                    content.append(chunk)
+                yield decoder.decode(chunk)
+            yield decoder.decode(b"", final=True)
+            if keep:
+                response._content = b"".join(content)
+                cache.store(request, response)
 
 
 def get_soup(url: str) -> bs4.BeautifulSoup:
     """Gets the HTML code of a page, parsed into a `bs4.BeautifulSoup`"""
-    logging.debug("GET {}", url)
-    response = requests.get(url, timeout=20)
-    response.raise_for_status()
-    return bs4.BeautifulSoup(response.text, "html.parser")
+    response = fetch("get", url)
+    with timed("parse"):
+        return bs4.BeautifulSoup(response.text, "html.parser")
+
+
+def make_thumbnail(image: bytes, size: int = 512, quality: int = 80) -> bytes:
+    """
+    Resizes an image (in any format supported by Pillow) so that it fits in a
+    `size` by `size` square, and encodes it in WebP
+    """
+    with Image.open(BytesIO(image)) as source:
+        img: Image.Image = source
+        if img.mode not in ["RGB", "RGBA"]:
+            img = img.convert("RGBA")
+        img.thumbnail((size, size))
+        buffer = BytesIO()
+        img.save(buffer, format="WEBP", quality=quality)
+    return buffer.getvalue()
 
 
 def process_string(x: str) -> Any:
@@ -74,6 +225,23 @@ def process_string(x: str) -> Any:
     return x
 
 
+def retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Returns the value of the `Retry-After` header of a response in seconds, or
+    `None` if absent or invalid
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    if re.match(r"^\d+$", value.strip()):
+        return float(value)
+    try:
+        dt = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, dt.timestamp() - datetime.datetime.now().timestamp())
+
+
 def url_or_pid_to_pid(key: str) -> str:
     """
     Extracts the property page id from a property page url. If the argument is
@@ -1,13 +1,19 @@
 # pylint: disable=missing-function-docstring
 # pylint: disable=unnecessary-lambda
+# pylint: disable=import-outside-toplevel
 """Webui"""
 
-from typing import List
+from base64 import b64encode
+from typing import List, Union
 
-import pymongo
-from nicegui import ui
+from nicegui import app, ui
+from nicegui.slot import Slot
+from prometheus_client import make_asgi_app
 
-from ielove import db, ielove, tasks
+from ielove.constants import ALL_PROPERTY_TYPES, ALL_REGIONS
+
+# The scraping and database modules (bs4, requests, Pillow, pymongo...) are
+# imported in the handlers that need them, to keep the startup time low.
 
 PROPERTY_ICONS = {
     "chintai": "real_estate_agent",
@@ -60,25 +66,38 @@ def populate_with_property(data: dict) -> None:
             ]
             props = "hide-header; wrap-cells"
             ui.table(columns=columns, rows=rows).props(props)
-        if "floor_plan" in data and "img" in data["floor_plan"]:
-            with splitter.after:
-                ui.image(
-                    "data:image/png;base64,"
-                    + str(data["floor_plan"]["img"].decode("utf-8"))
-                )
+        if "floor_plan" in data:
+            populate_with_floor_plan(data["floor_plan"], splitter.after)
+
+
+def populate_with_floor_plan(
+    floor_plan: dict, element: Union[ui.element, Slot]
+) -> None:
+    """
+    Populates an element (or a slot, e.g. a side of a splitter) with the
+    thumbnail of a floor plan, linking to the original image
+    """
+    from ielove import db
+
+    if "img" in floor_plan:  # Legacy documents embed the full image
+        src = "data:image/png;base64," + floor_plan["img"].decode("utf-8")
+    elif (document := db.get_floor_plan(floor_plan["url"])) is not None:
+        src = "data:image/webp;base64," + b64encode(
+            document["thumbnail"]
+        ).decode("utf-8")
+    else:
+        return
+    with element:
+        with ui.link(target=floor_plan["url"], new_tab=True):
+            ui.image(src)
 
 
 def s_search_by_address():
+    from ielove import db
+
     result_div.clear()
     key = str(le_search_field.value).strip()
-    # TODO: Move query logic to ielove.db ?
-    collection = db.get_collection("properties")
-    results = collection.find(
-        {"details.住所": {"$regex": f".*{key}.*"}},
-        sort=[("details.住所", pymongo.ASCENDING)],
-        limit=50,
-    )
-    results = list(results)
+    results = db.search_properties_by_address(key)
     if not results:
         ui.notify("No results", position="top", type="negative")
         return
@@ -87,6 +106,8 @@ def s_search_by_address():
 
 
 def s_search_by_id_or_url():
+    from ielove import db
+
     result_div.clear()
     key = str(le_search_field.value).strip()
     data = db.get_property(key)
@@ -97,6 +118,50 @@ def s_search_by_id_or_url():
         populate_with_properties([data])
 
 
+def s_show_stats():
+    from ielove.stats import get_stats
+
+    stats_div.clear()
+    results = get_stats(le_stats_property_type.value)
+    if not results:
+        ui.notify("No statistics", position="top", type="negative")
+        return
+    columns = [
+        {"label": k, "field": k}
+        for k in [
+            "type",
+            "prefecture",
+            "city",
+            "ward",
+            "count",
+            "mean_price",
+            "mean_price_per_m2",
+            "median_price_per_m2",
+        ]
+    ]
+    rows = [
+        {k: f"{v:,.0f}" if isinstance(v, float) else v for k, v in r.items()}
+        for r in results
+    ]
+    with stats_div:
+        ui.table(columns=columns, rows=rows).props("dense")
+
+
+def s_scrape_property_pages():
+    u = str(le_property_page_urls.value or "").split()
+    if not u:
+        ui.notify(
+            "Input property page URLs",
+            position="top",
+            type="negative",
+        )
+        return
+    from ielove import tasks
+
+    n = tasks.submit_property_pages(u)
+    ui.notify(f"Submitted {n} tasks", position="top", type="positive")
+
+
 def s_scrape_region():
     r = le_region.value
     t = le_property_type.value
@@ -108,7 +173,15 @@ def s_scrape_region():
             type="negative",
         )
         return
-    tasks.scrape_region.delay(r, t, l)
+    from ielove import frontier, tasks
+    from ielove.celery import INTERACTIVE
+
+    # Sent to the node owning the partition, see ielove.tasks._run_on_owner
+    tasks.scrape_region.apply_async(
+        (r, t, l),
+        queue=frontier.queue("discovery", t, r),
+        priority=INTERACTIVE["priority"],
+    )
     ui.notify("Submitted task", position="top", type="positive")
 
 
@@ -121,7 +194,10 @@ def s_scrape_result_page():
             type="negative",
         )
         return
-    tasks.scrape_result_page.delay(u)
+    from ielove import tasks
+    from ielove.celery import INTERACTIVE
+
+    tasks.scrape_result_page.apply_async((u,), **INTERACTIVE)
     ui.notify("Submitted task", position="top", type="positive")
 
 
@@ -134,12 +210,16 @@ def s_scrape_property_page():
             type="negative",
         )
         return
-    tasks.scrape_property_page.delay(u)
+    from ielove import tasks
+    from ielove.celery import INTERACTIVE
+
+    tasks.scrape_property_page.apply_async((u,), **INTERACTIVE)
     ui.notify("Submitted task", position="top", type="positive")
 
 
 with ui.tabs().classes("w-full") as tabs:
     tab_search = ui.tab("Search", icon="search")
+    tab_stats = ui.tab("Statistics", icon="query_stats")
     tab_jobs = ui.tab("Tasks", icon="add_task")
 
 with ui.tab_panels(tabs, value=tab_search).classes("w-full"):
@@ -159,6 +239,19 @@ with ui.tab_panels(tabs, value=tab_search).classes("w-full"):
                 )
             result_div = ui.element(tag="div")
 
+    with ui.tab_panel(tab_stats):
+        with ui.column():
+            with ui.row():
+                le_stats_property_type = ui.select(
+                    ALL_PROPERTY_TYPES, label="Property type"
+                ).classes("w-64")
+                ui.button(
+                    "Show",
+                    icon="query_stats",
+                    on_click=lambda: s_show_stats(),
+                )
+            stats_div = ui.element(tag="div")
+
     with ui.tab_panel(tab_jobs):
         with ui.column():
             with ui.expansion("Scrape property page").classes("w-full"):
@@ -172,6 +265,17 @@ with ui.tab_panels(tabs, value=tab_search).classes("w-full"):
                             icon="add_task",
                             on_click=lambda: s_scrape_property_page(),
                         )
+            with ui.expansion("Scrape property pages").classes("w-full"):
+                with ui.card():
+                    with ui.row().classes("w-full"):
+                        le_property_page_urls = ui.textarea(
+                            "Property page URLs, one per line"
+                        ).classes("w-1/2")
+                        ui.button(
+                            "Submit tasks",
+                            icon="add_task",
+                            on_click=lambda: s_scrape_property_pages(),
+                        )
             with ui.expansion("Scrape result page").classes("w-full"):
                 with ui.card():
                     with ui.row().classes("w-full"):
@@ -187,10 +291,10 @@ with ui.tab_panels(tabs, value=tab_search).classes("w-full"):
                 with ui.card():
                     with ui.row().classes("w-full"):
                         le_region = ui.select(
-                            ielove.ALL_REGIONS, label="Region"
+                            ALL_REGIONS, label="Region"
                         ).classes("w-1/4")
                         le_property_type = ui.select(
-                            ielove.ALL_PROPERTY_TYPES, label="Property type"
+                            ALL_PROPERTY_TYPES, label="Property type"
                         ).classes("w-1/4")
                         n_limit = ui.number(
                             label="Default page limit",
@@ -206,8 +310,12 @@ with ui.tab_panels(tabs, value=tab_search).classes("w-full"):
                         )
 
 
+app.mount("/metrics", make_asgi_app())
+
 if __name__ in ["__main__", "__mp_main__"]:
-    db.ensure_indices()
+    from ielove.db import ensure_indices
+
+    ensure_indices()
     ui.run(
         host="0.0.0.0",
         title="ielove",
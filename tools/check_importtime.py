@@ -0,0 +1,65 @@
+"""
+Checks that the enqueue-only paths of the CLI (`python3 -m ielove
+scrape-property-page ...` and the like) stay fast to start: importing them
+must not pull in any heavy dependency, and must take less than a budget (in
+milliseconds, default: 75, best of 5 runs in fresh interpreters).
+
+    python3 tools/check_importtime.py [BUDGET_MS]
+
+Exits with status 1 if any check fails. See also `make importtime`.
+"""
+
+import json
+import subprocess
+import sys
+
+STATEMENT = "import ielove.__main__; from ielove.celery import send_task"
+"""What an enqueue-only CLI command imports"""
+
+HEAVY = [
+    "bs4",
+    "celery",
+    "kombu",
+    "loguru",
+    "nicegui",
+    "PIL",
+    "pymongo",
+    "redis",
+    "requests",
+    "rich",
+]
+"""Modules that must not be imported by `STATEMENT`"""
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+{STATEMENT}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {HEAVY!r} if m in sys.modules]
+print(json.dumps({{"ms": elapsed * 1000, "heavy": heavy}}))
+"""
+
+
+def main() -> int:
+    """Runs the checks, see module documentation"""
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 75.0
+    runs = [
+        json.loads(
+            subprocess.run(
+                [sys.executable, "-c", PROBE],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+        )
+        for _ in range(5)
+    ]
+    ms, heavy = min(r["ms"] for r in runs), runs[0]["heavy"]
+    print(f"'{STATEMENT}': {ms:.1f} ms (budget: {budget:.0f} ms)")
+    if heavy:
+        print(f"Heavy modules imported: {', '.join(heavy)}")
+    return 0 if ms <= budget and not heavy else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())